@@ -10,6 +10,7 @@ from . import statement_aeb43
 from . import statement_analytic
 from . import account_bank
 from . import move
+from . import party
 from . import routes
 
 # We need to set the routes file here to activate the routes in tryton
@@ -21,14 +22,19 @@ def register():
     Pool.register(
         account.Move,
         account.MoveLine,
+        account.Invoice,
         enable_banking.EnableBankingConfiguration,
         enable_banking.EnableBankingSession,
         journal.JournalWeight,
         journal.Journal,
         journal.Cron,
+        party.Party,
         statement.Statement,
         statement.Line,
         statement.Origin,
+        statement.OriginFingerprint,
+        statement.OriginSuggestionStat,
+        statement.OriginWatch,
         statement.OriginSuggestedLine,
         statement.AddMultipleInvoicesStart,
         statement.AddMultipleMoveLinesStart,
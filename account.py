@@ -4,7 +4,7 @@ from sql import Column
 from sql.aggregate import Max
 
 from trytond.pool import Pool, PoolMeta
-from trytond.model import fields
+from trytond.model import ModelView, dualmethod, fields
 from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from trytond.modules.currency.fields import Monetary
@@ -17,6 +17,34 @@ class Move(metaclass=PoolMeta):
     def _get_origin(cls):
         return super()._get_origin() + ['account.statement.origin']
 
+    @dualmethod
+    @ModelView.button
+    def post(cls, moves):
+        Watch = Pool().get('account.statement.origin.watch')
+
+        super().post(moves)
+
+        # The new receivable and payable lines may be suggested to the
+        # origins waiting on their party or amount
+        watches = []
+        for move in moves:
+            for line in move.lines:
+                if not line.account.reconcile:
+                    continue
+                if line.party:
+                    watches.append(('party', Watch.party_value(line.party)))
+                # The origins wait on the amount in the currency of their
+                # statement
+                if line.debit or line.credit:
+                    watches.append(('amount', Watch.amount_value(
+                                line.debit - line.credit,
+                                move.company.currency)))
+                if line.second_currency and line.amount_second_currency:
+                    watches.append(('amount', Watch.amount_value(
+                                line.amount_second_currency,
+                                line.second_currency)))
+        Watch.notify(watches)
+
 
 class MoveLine(metaclass=PoolMeta):
     __name__ = 'account.move.line'
@@ -97,9 +125,43 @@ class MoveLine(metaclass=PoolMeta):
             description=description, delegate_to=delegate_to)
 
 
+class Invoice(metaclass=PoolMeta):
+    __name__ = 'account.invoice'
+
+    @classmethod
+    def _post(cls, invoices):
+        Watch = Pool().get('account.statement.origin.watch')
+
+        super()._post(invoices)
+
+        # Only the references are watched here, the party and amount of the
+        # lines are watched when their move is posted
+        watches = []
+        for invoice in invoices:
+            for text in (invoice.number, invoice.reference):
+                watches += [('reference', x)
+                    for x in Watch.reference_values(text)]
+        Watch.notify(watches)
+
+
 class Payment(metaclass=PoolMeta):
     __name__ = 'account.payment'
 
+    @classmethod
+    def create(cls, vlist):
+        Watch = Pool().get('account.statement.origin.watch')
+
+        payments = super().create(vlist)
+
+        watches = []
+        for payment in payments:
+            if payment.party:
+                watches.append(('party', Watch.party_value(payment.party)))
+            watches.append(('amount',
+                    Watch.amount_value(payment.amount, payment.currency)))
+        Watch.notify(watches)
+        return payments
+
     def get_rec_name(self, name):
         Invoice = Pool().get('account.invoice')
 
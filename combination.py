@@ -0,0 +1,337 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from itertools import accumulate, count, islice
+from multiprocessing import get_context
+from time import monotonic
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# TODO: Make DIGITS depend on the currency
+DIGITS = 2
+# Minimum number of lines to search pairs and triples with NumPy, below it the
+# cost of building the arrays is not worth it
+VECTORIZE_MIN_LINES = 64
+# Number of partial combinations visited between two checks of the deadline
+DEADLINE_CHECK_INTERVAL = 1024
+# Number of first lines searched before widening the search to the double of
+# lines until the budget is spent
+WIDENING_MIN_LINES = 32
+# Minimum number of lines to search in a pool of processes, below it sending
+# the amounts to the processes is slower than searching them in place
+PARALLEL_MIN_LINES = 256
+# Number of searches in the pool of processes whose cancellation is tracked at
+# the same time
+CANCEL_SLOTS = 1024
+
+_executor = None
+# The ids of the cancelled searches shared with the pool of processes, a
+# search being cancelled if its id is in its slot
+_cancelled = None
+_search_ids = count(1)
+
+
+def to_int(value, digits=DIGITS):
+    # Converting all Decimal to int to improve performance
+    # In several tests reduced the time by 30%
+    return int(value * 10 ** digits)
+
+
+class MoveLineSnapshot:
+    '''
+    Open move lines that can be used to build combinations.
+
+    Columns are stored in arrays of integers: the ids, the amounts converted
+    with to_int, the party ids (-1 if no party) and the maturity dates as
+    ordinals.
+    '''
+
+    def __init__(self, rows=()):
+        self.ids = array('q')
+        self.amounts = array('q')
+        self.parties = array('q')
+        self.dates = array('l')
+        for id_, amount, party, date_ in rows:
+            self.ids.append(id_)
+            self.amounts.append(amount)
+            self.parties.append(party if party is not None else -1)
+            self.dates.append(date_.toordinal())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def select(self, parties=None):
+        'Return the (id, amount, date) of the lines of parties'
+        if parties is not None:
+            parties = set(parties)
+        return [(id_, amount, date.fromordinal(date_))
+            for id_, amount, party, date_ in zip(
+                self.ids, self.amounts, self.parties, self.dates)
+            if parties is None or party in parties]
+
+
+class Budget:
+    '''
+    Count the partial combinations visited and stop when exhausted, when
+    the deadline, a time.monotonic() value, is reached or when cancelled, a
+    function, returns True.
+    '''
+
+    def __init__(self, limit=None, deadline=None, cancelled=None):
+        self.limit = limit
+        self.deadline = deadline
+        self.cancelled = cancelled
+        self.visited = 0
+        self.expired = False
+
+    def spend(self):
+        self.visited += 1
+        if not self.visited % DEADLINE_CHECK_INTERVAL:
+            self.stop()
+        return not self.expired and (self.limit is None
+            or self.visited <= self.limit)
+
+    def stop(self):
+        'Return if the deadline is reached or the search is cancelled'
+        self.expired = ((self.deadline is not None
+                and monotonic() >= self.deadline)
+            or (self.cancelled is not None and self.cancelled()))
+        return self.expired
+
+    @property
+    def exhausted(self):
+        return self.limit is not None and self.visited >= self.limit
+
+
+def find_combinations(lines, amount, tolerance=0, max_length=1, budget=None,
+        first_only=False, deadline=None, processes=0, limit=None):
+    '''
+    Yield the combinations of lines whose amounts sum amount +/- tolerance.
+
+    lines is a sequence of (id, amount) tuples with integer amounts sorted
+    by preference. Combinations are yielded by length and, inside the same
+    length, by prefixes of the lines of growing size and in the same order
+    itertools.combinations would produce them inside each prefix, so the
+    preference of the caller is kept.
+
+    The last line of each combination is not enumerated but looked up with a
+    binary search over the sorted amounts, so every combination of length k
+    costs the enumeration of its k - 1 first lines only. Partial combinations
+    are pruned as soon as the lines left can not reach the amount. If NumPy
+    is installed, pairs and triples are searched with vectorized lookups.
+
+    budget is the maximum number of partial combinations visited for each
+    length, spread over the prefixes, limit the maximum number of
+    combinations yielded by each length and first_only stops each length on
+    its first match. If deadline, a time.monotonic() value, is reached the
+    search stops and only the combinations already yielded are found.
+
+    If processes is set and there are at least PARALLEL_MIN_LINES lines, each
+    length is searched in a pool of processes and the results are yielded in
+    the same order. The searches still running in the pool stop once the
+    caller stops consuming the combinations.
+    '''
+    lines = tuple(lines)
+    amounts = [x[1] for x in lines]
+    lengths = range(1, min(max_length, len(lines)) + 1)
+    if first_only:
+        limit = 1
+    if processes and len(lengths) > 1 and len(lines) >= PARALLEL_MIN_LINES:
+        executor = get_executor(processes)
+        search_id = next(_search_ids)
+        futures = [executor.submit(_find_length_indexes, amounts, amount,
+                tolerance, length, budget, limit, deadline, search_id)
+            for length in lengths]
+        try:
+            for future in futures:
+                for indexes in future.result():
+                    yield tuple(lines[i] for i in indexes)
+        finally:
+            # The caller may stop before consuming all the lengths, so the
+            # pending searches are cancelled and the running ones stopped
+            for future in futures:
+                future.cancel()
+            _cancelled[search_id % CANCEL_SLOTS] = search_id
+        return
+
+    search = _Search(amounts, max_length)
+    for length in lengths:
+        if deadline is not None and monotonic() >= deadline:
+            return
+        yield from (tuple(lines[i] for i in indexes)
+            for indexes in islice(search.find(amount, tolerance, length,
+                    Budget(budget, deadline)), limit))
+
+
+def get_executor(processes):
+    '''
+    Return the pool of processes used to search combinations.
+
+    It is created the first time and kept for the life of the process. The
+    processes are spawned because forking a multi-threaded server is not
+    safe.
+    '''
+    global _executor, _cancelled
+    if _executor is None:
+        context = get_context('spawn')
+        _cancelled = context.Array('q', CANCEL_SLOTS, lock=False)
+        _executor = ProcessPoolExecutor(max_workers=processes,
+            mp_context=context, initializer=_init_process,
+            initargs=(_cancelled,))
+    return _executor
+
+
+def _init_process(cancelled):
+    global _cancelled
+    _cancelled = cancelled
+
+
+def _find_length_indexes(amounts, amount, tolerance, length, budget, limit,
+        deadline, search_id):
+    'Return the indexes of the combinations of length, run by the pool'
+    def cancelled():
+        return _cancelled[search_id % CANCEL_SLOTS] == search_id
+
+    search = _Search(amounts, length)
+    return list(islice(search.find(amount, tolerance, length,
+                Budget(budget, deadline, cancelled)), limit))
+
+
+class _Search:
+    'Lookup structures of amounts shared by the search of every length'
+
+    def __init__(self, amounts, max_length):
+        self.amounts = amounts
+        self.order = sorted(range(len(amounts)), key=amounts.__getitem__)
+        self.sorted_amounts = [amounts[i] for i in self.order]
+        self.lows, self.highs = suffix_bounds(amounts, max_length)
+        self.arrays = None
+        if np is not None and len(amounts) >= VECTORIZE_MIN_LINES:
+            self.arrays = (np.array(amounts, dtype=np.int64),
+                np.array(self.order, dtype=np.int64),
+                np.array(self.sorted_amounts, dtype=np.int64))
+
+    def find(self, amount, tolerance, length, budget):
+        'Yield the indexes of the combinations of length within the Budget'
+        if self.arrays is not None and length in {2, 3}:
+            # Pairs and triples are the most usual matches so all of them
+            # are searched regardless of the limit of the budget
+            return _find_length_vectorized(*self.arrays, amount, tolerance,
+                length, budget)
+        return _find_length(self.amounts, self.order, self.sorted_amounts,
+            self.lows, self.highs, amount, tolerance, length, budget)
+
+
+def suffix_bounds(amounts, count):
+    '''
+    Return the minimum and maximum sums reachable with up to count amounts
+    taken from each position to the end.
+
+    lows[i][r] is the sum of the r smallest amounts from position i, which
+    takes all the credits first, and highs[i][r] the sum of the r largest,
+    which takes all the debits first.
+    '''
+    size = len(amounts)
+    lows = [(0,)] * (size + 1)
+    highs = [(0,)] * (size + 1)
+    smallest, largest = [], []
+    for index in range(size - 1, -1, -1):
+        insort(smallest, amounts[index])
+        del smallest[count:]
+        insort(largest, -amounts[index])
+        del largest[count:]
+        lows[index] = tuple(accumulate(smallest, initial=0))
+        highs[index] = tuple(-x for x in accumulate(largest, initial=0))
+    return lows, highs
+
+
+def _find_length(amounts, order, sorted_amounts, lows, highs, amount,
+        tolerance, length, budget):
+    '''
+    Yield the indexes of the combinations of length.
+
+    The lines are searched in prefixes of growing size, from
+    WIDENING_MIN_LINES lines and doubling it, so the budget is spread over the
+    first lines instead of being spent in the combinations of the first one.
+    Each prefix only yields the combinations whose last line is not in the
+    previous prefix.
+    '''
+    size = len(amounts)
+
+    def reachable(start, count, total):
+        'Return if count lines from start can complete total'
+        return (total + lows[start][count] <= amount + tolerance
+            and total + highs[start][count] >= amount - tolerance)
+
+    def last(start, total, lower, limit):
+        'Return the indexes in [max(start, lower), limit) completing total'
+        low = bisect_left(sorted_amounts, amount - total - tolerance)
+        high = bisect_right(sorted_amounts, amount - total + tolerance)
+        start = max(start, lower)
+        return sorted(i for i in order[low:high] if start <= i < limit)
+
+    def walk(start, depth, total, prefix, lower, limit):
+        if depth == length - 1:
+            for index in last(start, total, lower, limit):
+                yield prefix + (index,)
+            return
+        left = length - 1 - depth
+        # Keep room for the lines still to be chosen
+        for index in range(start, limit - left):
+            subtotal = total + amounts[index]
+            if not reachable(index + 1, left, subtotal):
+                continue
+            if not budget.spend():
+                return
+            yield from walk(index + 1, depth + 1, subtotal,
+                prefix + (index,), lower, limit)
+
+    if not reachable(0, length, 0):
+        return
+    lower, limit = 0, min(size, WIDENING_MIN_LINES)
+    while True:
+        yield from walk(0, 0, 0, (), lower, limit)
+        if limit >= size or budget.expired or budget.exhausted:
+            return
+        lower, limit = limit, min(size, 2 * limit)
+
+
+def _find_length_vectorized(amounts, order, sorted_amounts, amount,
+        tolerance, length, budget):
+    '''
+    Same as _find_length for pairs and triples but using NumPy arrays, only
+    stopped by the deadline or the cancellation of budget
+    '''
+
+    def complete(totals):
+        'Return the range of sorted_amounts that completes each total'
+        low = np.searchsorted(sorted_amounts, amount - totals - tolerance,
+            side='left')
+        high = np.searchsorted(sorted_amounts, amount - totals + tolerance,
+            side='right')
+        return low, high
+
+    def last(low, high, start):
+        indexes = np.sort(order[low:high])
+        return indexes[indexes >= start].tolist()
+
+    if length == 2:
+        low, high = complete(amounts)
+        for first in np.flatnonzero(high > low).tolist():
+            for index in last(low[first], high[first], first + 1):
+                yield (first, index)
+    elif length == 3:
+        for first in range(len(amounts) - 2):
+            if budget.stop():
+                return
+            low, high = complete(amounts[first] + amounts[first + 1:])
+            for offset in np.flatnonzero(high > low).tolist():
+                second = first + 1 + offset
+                for index in last(low[offset], high[offset], second + 1):
+                    yield (first, second, index)
@@ -2,9 +2,12 @@
 # this repository contains the full copyright notices and license terms.
 import time
 import requests
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from decimal import Decimal
 from datetime import datetime, timedelta
+from sql import Literal
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case
 from trytond.cache import Cache
 import trytond.config as config
 from trytond.pool import Pool, PoolMeta
@@ -15,8 +18,15 @@ from trytond.transaction import Transaction
 from trytond.model.exceptions import AccessError
 from trytond.exceptions import UserError
 from .common import get_base_header, load_session_json, URL
+from .suggestion import get_memo
+from .tuning import tune
 
 QUEUE_NAME = config.get('enable_banking', 'queue_name', default='default')
+# Number of processes used to tune the weights, 0 tunes them in the worker
+TUNING_PROCESSES = config.getint('enable_banking', 'tuning_processes',
+    default=0)
+# Number of the last posted origins used to tune the weights
+TUNING_ORIGINS = 1000
 
 DEFAULT_WEIGHTS = {
     'based-on-match': 10,
@@ -31,10 +41,13 @@ DEFAULT_WEIGHTS = {
     'party-match': 20,
     'party-uniformity': 10,
     'max-suggestion-count': 10,
-    # 100.000 combinations takes between 0.02 and 0.1 seconds in a laptop
-    # 1.000.000 combinations takes between 0.2 and 1 seconds in a laptop
-    # Note that it will be computed up to 20 times, so multiply by 20 to get
-    # the total time
+    # Maximum time in milliseconds spent searching suggestions for each
+    # origin, the best suggestions found so far are kept. 0 means no limit
+    'suggestion-time-limit': 60_000,
+    # Maximum number of partial combinations visited for each combination
+    # length. 100.000 takes between 0.02 and 0.1 seconds in a laptop and
+    # 1.000.000 between 0.2 and 1 seconds. Note that it will be computed up to
+    # 20 times, so multiply by 20 to get the total time
     'target-combinations': 100_000,
     'type-combination-party': 105,
     'type-combination-all': 100,
@@ -47,6 +60,34 @@ DEFAULT_WEIGHTS = {
     }
 
 
+class WeightProfile(namedtuple('WeightProfile',
+            [x.replace('-', '_') for x in DEFAULT_WEIGHTS])):
+    '''
+    The weights of a journal as attributes, with '-' replaced by '_' in
+    their types.
+    '''
+    __slots__ = ()
+
+    def type_weight(self, type_):
+        'Return the weight of the suggestion type_'
+        if not type_:
+            return 0
+        return getattr(self, 'type_' + type_.replace('-', '_'))
+
+    def max_weight(self, type_):
+        '''
+        Return the greatest weight a suggestion of type_ can get, with all
+        the scores of its features at 1
+        '''
+        return (self.type_weight(type_) + self.party_uniformity
+            + self.date_match + self.party_match + self.number_match
+            + self.based_on_match)
+
+    def to_weights(self):
+        'Return a dictionary of the weights by type, like DEFAULT_WEIGHTS'
+        return {k.replace('_', '-'): v for k, v in self._asdict().items()}
+
+
 class JournalWeight(ModelSQL, ModelView):
     'Journal Weight'
     __name__ = 'account.statement.journal.weight'
@@ -66,6 +107,7 @@ class JournalWeight(ModelSQL, ModelView):
             ('origin-similarity-threshold', 'Origin Similarity Threshold'),
             ('party-match', 'Party Match'),
             ('party-uniformity', 'Party Uniformity'),
+            ('suggestion-time-limit', 'Suggestion Time Limit (ms)'),
             ('target-combinations', 'Target Combinations'),
             ('type-combination-party', 'Type Combination Party'),
             ('type-combination-all', 'Type Combination All'),
@@ -101,18 +143,21 @@ class JournalWeight(ModelSQL, ModelView):
     def create(cls, vlist):
         Journal = Pool().get('account.statement.journal')
         Journal._get_weight_cache.clear()
+        get_memo(Transaction()).pop('weight_profiles', None)
         return super().create(vlist)
 
     @classmethod
     def write(cls, *args):
         Journal = Pool().get('account.statement.journal')
         Journal._get_weight_cache.clear()
+        get_memo(Transaction()).pop('weight_profiles', None)
         super().write(*args)
 
     @classmethod
     def delete(cls, records):
         Journal = Pool().get('account.statement.journal')
         Journal._get_weight_cache.clear()
+        get_memo(Transaction()).pop('weight_profiles', None)
         return super().delete(records)
 
 
@@ -186,6 +231,8 @@ class Journal(metaclass=PoolMeta):
                 'retrieve_enable_banking_session': {},
                 'synchronize_statement_enable_banking': {},
                 'evaluate_weights': {},
+                'tune_weights': {},
+                'suggestion_stats': {},
                 })
 
     @classmethod
@@ -259,6 +306,18 @@ class Journal(metaclass=PoolMeta):
         self._get_weight_cache.set(key, value)
         return value
 
+    def get_weight_profile(self):
+        'Return the WeightProfile of the journal, built once per transaction'
+        profiles = get_memo(Transaction()).setdefault('weight_profiles', {})
+        profile = profiles.get(self.id)
+        if profile is None:
+            weights = dict(DEFAULT_WEIGHTS)
+            weights.update((x.type, x.weight) for x in self.weights
+                if x.type in DEFAULT_WEIGHTS)
+            profile = profiles[self.id] = WeightProfile(
+                **{k.replace('-', '_'): v for k, v in weights.items()})
+        return profile
+
     def _keys_not_needed(self):
         # Main keys
         keys = [
@@ -276,24 +335,30 @@ class Journal(metaclass=PoolMeta):
             ]
         return keys
 
+    @staticmethod
+    def _tuplify(line):
+        'Return a comparable tuple of a statement line or suggested line'
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Invoice = pool.get('account.invoice')
+        MoveLine = pool.get('account.move.line')
+
+        x = line.related_to
+        if (isinstance(x, Payment) and x.line
+                and isinstance(x.line.move_origin, Invoice)):
+            x = x.move_origin
+        elif isinstance(x, MoveLine) and isinstance(x.move_origin, Invoice):
+            x = x.move_origin
+        return (str(line.account), str(line.party), line.amount,
+            str(x))
+
     @classmethod
     @ModelView.button
     def evaluate_weights(cls, journals):
         pool = Pool()
         Origin = pool.get('account.statement.origin')
-        Payment = pool.get('account.payment')
-        Invoice = pool.get('account.invoice')
-        MoveLine = pool.get('account.move.line')
 
-        def tuplify(line):
-            x = line.related_to
-            if (isinstance(x, Payment) and x.line
-                    and isinstance(x.line.move_origin, Invoice)):
-                x = x.move_origin
-            elif isinstance(x, MoveLine) and isinstance(x.move_origin, Invoice):
-                x = x.move_origin
-            return (str(line.account), str(line.party), line.amount,
-                str(x))
+        tuplify = cls._tuplify
 
         reports = []
         for journal in journals:
@@ -341,6 +406,108 @@ class Journal(metaclass=PoolMeta):
 
         raise UserError('\n\n'.join(reports))
 
+    def _get_tuning_case(self, origin):
+        '''
+        Return the snapshot of the features of the suggestions of a posted
+        origin used by tuning.tune
+        '''
+        tuplify = self._tuplify
+        target = sorted(tuplify(x) for x in origin.lines)
+        target_index = None
+        suggestions = []
+        for suggestion in origin.suggested_lines:
+            if suggestion.parent:
+                continue
+            if suggestion.childs:
+                tuplified = sorted(tuplify(x) for x in suggestion.childs)
+                parties = len({x.party for x in suggestion.childs if x.party})
+                leaves = tuple(tuple(x.get_weight_features())
+                    for x in suggestion.childs)
+            else:
+                tuplified = [tuplify(suggestion)]
+                parties = None
+                leaves = (tuple(suggestion.get_weight_features()),)
+            if target_index is None and tuplified == target:
+                target_index = len(suggestions)
+            suggestions.append((suggestion.type, parties, leaves))
+        return target_index, suggestions
+
+    @classmethod
+    @ModelView.button
+    def tune_weights(cls, journals):
+        '''
+        Search the weights which would have used the most suggestions that
+        match the lines of the last posted origins and report them with
+        their gain
+        '''
+        pool = Pool()
+        Origin = pool.get('account.statement.origin')
+
+        reports = []
+        for journal in journals:
+            origins = Origin.search([
+                    ('statement.journal', '=', journal.id),
+                    ('state', '=', 'posted'),
+                    ], order=[
+                    ('date', 'DESC'),
+                    ('id', 'DESC'),
+                    ], limit=TUNING_ORIGINS)
+            cases = [journal._get_tuning_case(x) for x in origins]
+            weights = journal.get_weight_profile().to_weights()
+            best, initial, hits = tune(cases, weights,
+                processes=TUNING_PROCESSES)
+
+            report = (f'Journal {journal.name} ({journal.id}) tuned on '
+                f'{len(cases)} origins:\n\n'
+                f'  Suggestions used: {initial} -> {hits}\n')
+            for type_ in sorted(best):
+                if best[type_] != weights[type_]:
+                    report += f'  {type_}: {weights[type_]} -> {best[type_]}\n'
+            reports.append(report)
+
+        raise UserError('\n\n'.join(reports))
+
+    @classmethod
+    @ModelView.button
+    def suggestion_stats(cls, journals):
+        '''
+        Report by strategy the time, queries, candidates and suggestions of
+        the last suggestion search of the origins and how many of them were
+        used or posted
+        '''
+        pool = Pool()
+        Stat = pool.get('account.statement.origin.suggestion.stat')
+        stat = Stat.__table__()
+        cursor = Transaction().connection.cursor()
+
+        reports = []
+        for journal in journals:
+            duration = Sum(stat.duration)
+            cursor.execute(*stat.select(
+                    stat.strategy,
+                    Count(Literal('*')),
+                    duration,
+                    Sum(stat.queries),
+                    Sum(stat.candidates),
+                    Sum(stat.suggestions),
+                    Sum(Case((stat.used, 1), else_=0)),
+                    Sum(Case((stat.posted, 1), else_=0)),
+                    where=stat.journal == journal.id,
+                    group_by=[stat.strategy],
+                    order_by=[duration.desc]))
+            report = f'Journal {journal.name} ({journal.id}):\n\n'
+            for (strategy, runs, duration, queries, candidates, suggestions,
+                    used, posted) in cursor:
+                report += (f'  {strategy}: {runs} runs, '
+                    f'{duration / runs * 1000:.1f} ms, '
+                    f'{queries / runs:.1f} queries, '
+                    f'{candidates / runs:.1f} candidates, '
+                    f'{suggestions} suggestions, '
+                    f'used {used}, posted {posted}\n')
+            reports.append(report)
+
+        raise UserError('\n\n'.join(reports))
+
     @classmethod
     @ModelView.button_action('account_statement_enable_banking.'
         'act_enable_banking_retrieve_session')
@@ -584,15 +751,13 @@ class Journal(metaclass=PoolMeta):
             self.set_number(to_save)
 
             # Get the suggested lines for each origin created
-            # Use __queue__ to ensure the Bank lines download and origin
+            # Use the queue to ensure the Bank lines download and origin
             # creation are done and saved before start to create the
-            # suggestions. And use a worker for each origin to ensure that
-            # all origin try to search even one fails and can be done in
-            # parallel.
+            # suggestions. The origins are searched in chunks by different
+            # workers and the origins of a failed chunk are retried alone to
+            # ensure that all origin try to search even one fails.
             if self.search_suggestions:
-                with Transaction().set_context(queue_name=QUEUE_NAME):
-                    for origin in statement.origins:
-                        StatementOrigin.__queue__.search_suggestions([origin])
+                StatementOrigin.enqueue_search_suggestions(statement.origins)
         else:
             with Transaction().set_context(_skip_warnings=True):
                 Statement.validate_statement([statement])
@@ -0,0 +1,72 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+
+class SuffixAutomaton:
+    '''
+    Suffix automaton of a text.
+
+    It is built in linear time once per text and then the longest common
+    substring with any needle is found in linear time on the length of the
+    needle.
+    '''
+    __slots__ = ('transitions', 'links', 'lengths')
+
+    def __init__(self, text):
+        self.transitions = [{}]
+        self.links = [-1]
+        self.lengths = [0]
+        last = 0
+        for char in text:
+            last = self._extend(last, char)
+
+    def _add_state(self, length, transitions, link):
+        self.transitions.append(transitions)
+        self.lengths.append(length)
+        self.links.append(link)
+        return len(self.lengths) - 1
+
+    def _extend(self, last, char):
+        transitions, links, lengths = (
+            self.transitions, self.links, self.lengths)
+        current = self._add_state(lengths[last] + 1, {}, -1)
+        state = last
+        while state != -1 and char not in transitions[state]:
+            transitions[state][char] = current
+            state = links[state]
+        if state == -1:
+            links[current] = 0
+        else:
+            following = transitions[state][char]
+            if lengths[state] + 1 == lengths[following]:
+                links[current] = following
+            else:
+                clone = self._add_state(lengths[state] + 1,
+                    dict(transitions[following]), links[following])
+                while (state != -1
+                        and transitions[state].get(char) == following):
+                    transitions[state][char] = clone
+                    state = links[state]
+                links[following] = links[current] = clone
+        return current
+
+    def longest_common_substring(self, needle):
+        'Return the length of the longest substring of needle in the text'
+        transitions, links, lengths = (
+            self.transitions, self.links, self.lengths)
+        state = length = best = 0
+        for char in needle:
+            if char in transitions[state]:
+                state = transitions[state][char]
+                length += 1
+            else:
+                while state != -1 and char not in transitions[state]:
+                    state = links[state]
+                if state == -1:
+                    state = length = 0
+                else:
+                    length = lengths[state] + 1
+                    state = transitions[state][char]
+            if length > best:
+                best = length
+        return best
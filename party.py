@@ -0,0 +1,19 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.model import Index
+from trytond.pool import PoolMeta
+
+
+class Party(metaclass=PoolMeta):
+    __name__ = 'party.party'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        # Trigram indexes used by Origin.similar_parties_queries
+        cls._sql_indexes.add(
+            Index(t, (Index.Unaccent(t.name), Index.Similarity())))
+        if hasattr(cls, 'trade_name'):
+            cls._sql_indexes.add(
+                Index(t, (Index.Unaccent(t.trade_name), Index.Similarity())))
@@ -1,7 +1,7 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 import re
-import difflib
+import json
 import hashlib
 import math
 import requests
@@ -10,18 +10,28 @@ from unidecode import unidecode
 from datetime import datetime, UTC, timedelta
 from decimal import Decimal
 from secrets import token_hex
-from itertools import chain, combinations, groupby
-from sql import Literal
-from sql.conditionals import Coalesce, Greatest
-from sql.functions import Abs, Function
-from trytond.model import Workflow, ModelView, ModelSQL, fields, tree
+from collections import Counter, defaultdict
+from itertools import chain, groupby
+from sql import Literal, Null, Values
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case
+from sql.functions import Function
+from sql.operators import BinaryOperator
+from trytond.model import (
+    Workflow, ModelView, ModelSQL, Index, Unique, fields, tree)
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool, If, PYSON, PYSONEncoder
 from trytond.rpc import RPC
 from trytond.wizard import (
     Button, StateAction, StateTransition, StateView, Wizard)
-from trytond.transaction import Transaction
+from trytond.transaction import Transaction, TransactionError
+from trytond.tools import grouped_slice
 from .common import get_base_header, load_session_json, URL, REDIRECT_URL
+from .combination import MoveLineSnapshot, find_combinations, to_int
+from .journal import QUEUE_NAME
+from .matching import SuffixAutomaton
+from .suggestion import (Deadline, OriginSearch, Strategy, StrategyStat,
+    SuggestionRun, TopSuggestions, get_memo)
 from trytond.i18n import gettext
 from trytond.exceptions import UserWarning
 from trytond.model.exceptions import AccessError
@@ -36,27 +46,41 @@ ZERO = Decimal(0)
 PRODUCTION = config.get('database', 'production', default=False)
 PARTY_SIMILARITY_THRESHOLD = config.get('enable_banking',
     'party_similarity_threshold', default=0.13)
-
-@functools.cache
+# Number of texts kept with their suffix automaton to compute
+# longest_common_substring
+MATCHING_CACHE_SIZE = config.getint('enable_banking', 'matching_cache_size',
+    default=128)
+# Number of processes used to search combinations of move lines, 0 searches
+# them in the worker itself
+COMBINATION_PROCESSES = config.getint('enable_banking',
+    'combination_processes', default=0)
+# Store the time, candidates and suggestions of each strategy of
+# search_suggestions in account.statement.origin.suggestion.stat to order the
+# strategies of each journal by their hit rate
+SUGGESTION_STATS = config.getboolean('enable_banking', 'suggestion_stats',
+    default=False)
+# Count the queries of each strategy of search_suggestions, which wraps the
+# cursors of the transaction
+SUGGESTION_QUERY_STATS = config.getboolean('enable_banking',
+    'suggestion_query_stats', default=False)
+# Minimum number of runs of a strategy in a journal to order it by its
+# statistics
+STRATEGY_MIN_RUNS = 20
+# Number of origins of the same journal whose suggestions are searched by
+# the same queue task
+SUGGESTION_CHUNK_SIZE = config.getint('enable_banking',
+    'suggestion_chunk_size', default=1)
+# Maximum number of origins watching the same reference for a new document
+# with it to queue their search, more are considered a too common reference
+MAX_REFERENCE_WATCHES = 5
+
+@functools.lru_cache(maxsize=1024)
 def gaussian_score(x, mean, stddev):
     'Return 1 at x==mean and decay like a Gaussian as |x-mean| increases.'
     if stddev <= 0:
         raise ValueError("stddev must be positive")
     return math.exp(-((x - mean) ** 2) / (2.0 * (stddev ** 2)))
 
-@functools.cache
-def candidate_size(k, target_combinations, max_n=10000):
-    low = k
-    high = 1000000
-    while low < high:
-        mid = (low + high) // 2
-        if math.comb(mid, k) < target_combinations:
-            low = mid + 1
-        else:
-            high = mid
-    n = low
-    return min(n, max_n)
-
 def clean_string(s):
     s = unidecode(s.lower())
     # remove punctuation, keep letters/digits/space
@@ -65,19 +89,25 @@ def clean_string(s):
     s = re.sub(r"\s+", " ", s).strip()
     return s
 
-@functools.cache
-def longest_common_substring(a, b):
-    a = clean_string(a)
-    b = clean_string(b)
-    matcher = difflib.SequenceMatcher(None, a, b)
-    match = matcher.find_longest_match(0, len(a), 0, len(b))
-    return match.size
+@functools.lru_cache(maxsize=MATCHING_CACHE_SIZE)
+def text_automaton(text):
+    return SuffixAutomaton(clean_string(text))
+
+def longest_common_substring(text, needle):
+    '''
+    Return the length of the longest common substring of text and needle
+    once cleaned.
+    The automaton of text is built once and kept in a bounded LRU cache
+    (see text_automaton.cache_info()) so any number of needles can be
+    compared with the same text.
+    '''
+    return text_automaton(text).longest_common_substring(clean_string(needle))
 
 def compare_party(party_name, text):
+    'Compare party_name with text, which must be already cleaned'
     if not party_name:
         return 0
     party_name = clean_string(party_name)
-    text = clean_string(text)
     names = [party_name]
     if ' ' in party_name:
         # Change the last word for the first one
@@ -85,7 +115,7 @@ def compare_party(party_name, text):
         names.append(end + ' ' + start)
     percent = 0
     for name in names:
-        length = longest_common_substring(name, text)
+        length = longest_common_substring(text, name)
         percent = max(length / len(name), percent)
     return int(round(percent * 100))
 
@@ -99,6 +129,31 @@ else:
         _function = 'JSON_EXTRACT'
 
 
+class TrigramMatch(BinaryOperator):
+    'The % operator of pg_trgm, which can use the trigram indexes'
+    __slots__ = ()
+    _operator = '%%'
+
+
+def similarity_match(column, value, threshold):
+    '''
+    Return the condition of the similarity of column and value being at least
+    threshold.
+    On PostgreSQL with pg_trgm the % operator is added, with threshold set as
+    similarity limit of the transaction, so the planner can use the trigram
+    indexes.
+    '''
+    transaction = Transaction()
+    condition = Similarity(column, value) >= threshold
+    if (backend.name == 'postgresql'
+            and transaction.database.has_similarity()):
+        cursor = transaction.connection.cursor()
+        cursor.execute('SELECT set_config(%s, %s, true)',
+            ('pg_trgm.similarity_threshold', str(threshold)))
+        condition = TrigramMatch(column, value) & condition
+    return condition
+
+
 class Statement(metaclass=PoolMeta):
     __name__ = 'account.statement'
 
@@ -835,6 +890,13 @@ class Origin(Workflow, metaclass=PoolMeta):
     remittance_information = fields.Function(
         fields.Char('Remittance Information'), 'get_remittance_information',
         searcher='search_remittance_information')
+    clean_remittance_information = fields.Char(
+        "Clean Remittance Information", readonly=True,
+        help="The remittance information normalized by clean_string.")
+    clean_counterpart_name = fields.Char("Clean Counterpart Name",
+        readonly=True,
+        help="The debtor name of incomes or the creditor name of payments, "
+        "normalized by clean_string.")
     synchronized = fields.Function(fields.Boolean('Synchronized'),
         'on_change_with_synchronized')
 
@@ -844,6 +906,10 @@ class Origin(Workflow, metaclass=PoolMeta):
         cls.number.search_unaccented = False
         cls._order.insert(0, ('date', 'ASC'))
         cls._order.insert(1, ('number', 'ASC'))
+        t = cls.__table__()
+        # Trigram index used by similar_origins
+        cls._sql_indexes.add(
+            Index(t, (t.clean_remittance_information, Index.Similarity())))
 
         _sync_readonly = Bool(Eval('synchronized', False))
         _state_readonly = ~Eval('statement_state', '').in_(['draft',
@@ -952,6 +1018,72 @@ class Origin(Workflow, metaclass=PoolMeta):
         #return [x.id for x in suggested_lines if x.state == 'proposed']
         return suggested_lines
 
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        fill_clean = not table_h.column_exist('clean_remittance_information')
+
+        super().__register__(module_name)
+
+        if fill_clean:
+            cls._fill_clean_information()
+
+    @classmethod
+    def _fill_clean_information(cls):
+        "Set the clean columns of the existing origins"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.select(table.id, table.information, table.amount,
+                where=table.information != Null))
+        for id_, information, amount in cursor.fetchall():
+            if isinstance(information, str):
+                information = json.loads(information)
+            values = cls._clean_information(information, amount)
+            cursor.execute(*table.update(
+                    [getattr(table, x) for x in values],
+                    list(values.values()),
+                    where=table.id == id_))
+
+    @classmethod
+    def _clean_information(cls, information, amount):
+        "Return the values of the clean columns for information and amount"
+        information = information or {}
+        remittance_information = information.get('remittance_information')
+        counterpart_name = None
+        if amount and amount > 0:
+            counterpart_name = information.get('debtor_name')
+        elif amount and amount < 0:
+            counterpart_name = information.get('creditor_name')
+        return {
+            'clean_remittance_information': (
+                clean_string(remittance_information) or None
+                if remittance_information else None),
+            'clean_counterpart_name': (clean_string(counterpart_name) or None
+                if counterpart_name else None),
+            }
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        for values in vlist:
+            values.update(cls._clean_information(values.get('information'),
+                    values.get('amount')))
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        actions = iter(args)
+        to_clean = []
+        for origins, values in zip(actions, actions):
+            if {'information', 'amount'} & values.keys():
+                to_clean.extend(origins)
+        if to_clean:
+            cls.write(*chain.from_iterable(
+                    ([x], cls._clean_information(x.information, x.amount))
+                    for x in to_clean))
+
     def get_remittance_information(self, name):
         return (self.information.get('remittance_information', '')
             if self.information else '')
@@ -966,21 +1098,16 @@ class Origin(Workflow, metaclass=PoolMeta):
         pool = Pool()
         StatementOrigin = pool.get('account.statement.origin')
 
-        database = Transaction().database
-
         origin_table = StatementOrigin.__table__()
         cursor = Transaction().connection.cursor()
         _, operator, value = clause
         operator = 'in' if value else 'not in'
 
-        if backend.name == 'postgresql':
-            remittance_information_column = JsonExtract(
-                    origin_table.information, 'remittance_information')
-        else:
-            remittance_information_column = origin_table.information
+        if value:
+            # Clean each part between the wildcards like the column
+            value = '%'.join(clean_string(x) for x in value.split('%'))
         query = origin_table.select(origin_table.id,
-            where=(database.unaccent(remittance_information_column).ilike(
-                    database.unaccent(value))))
+            where=origin_table.clean_remittance_information.ilike(value))
         cursor.execute(*query)
         return [('id', operator, [x[0] for x in cursor.fetchall()])]
 
@@ -1206,57 +1333,85 @@ class Origin(Workflow, metaclass=PoolMeta):
         return moves
 
     def similar_parties_query(self, text):
+        return self.similar_parties_queries(self.company, [text]).get(text, {})
+
+    @classmethod
+    def similar_parties_queries(cls, company, texts):
+        """
+        Return a dictionary with the texts on 'key' and, on 'value', the
+        dictionary of their similar parties and similarity, like
+        similar_parties_query.
+        All the texts are compared with the parties in a single query joining
+        a VALUES list with the party table.
+        """
         pool = Pool()
         Party = pool.get('party.party')
         Rule = pool.get('ir.rule')
 
         party_table = Party.__table__()
         cursor = Transaction().connection.cursor()
+        database = Transaction().database
 
-        if not text:
+        texts = sorted({x for x in texts if x})
+        if not texts:
             return {}
 
-        database = Transaction().database
-
         create_similarity()
-        similarity = Similarity(database.unaccent(party_table.name),
-            database.unaccent(text))
-        if hasattr(Party, 'trade_name'):
-            similarity = Greatest(similarity,
-                Similarity(database.unaccent(party_table.trade_name),
-                    database.unaccent(text)))
-
-        where = ((similarity >= PARTY_SIMILARITY_THRESHOLD)
-            & (party_table.active))
-
-        # If party_company module is installed, ensure that when try to search
-        # suggestions called by cron, user id 0, not search on parties not
-        # allowed in the company.
-        if hasattr(Party, 'companies'):
-            PartyCompany = pool.get('party.company.rel')
-            party_company_table = PartyCompany.__table__()
-            company_query = party_company_table.select(
-                party_company_table.party,
-                where=party_company_table.company == self.company.id)
-            where &= (party_table.id.in_(company_query))
-
-        query = party_table.select(party_table.id, similarity, where=where)
-        cursor.execute(*query)
-
-        records = cursor.fetchall()
+        records = []
+        for sub_texts in grouped_slice(texts, backend.MAX_QUERY_PARAMS):
+            values = Values([[x] for x in sub_texts])
+            text = values.column1
+            # The texts are already unaccented by clean_string
+            where = similarity_match(database.unaccent(party_table.name),
+                text, PARTY_SIMILARITY_THRESHOLD)
+            if hasattr(Party, 'trade_name'):
+                where |= similarity_match(
+                    database.unaccent(party_table.trade_name),
+                    text, PARTY_SIMILARITY_THRESHOLD)
+            where &= party_table.active
+
+            # If party_company module is installed, ensure that when try to
+            # search suggestions called by cron, user id 0, not search on
+            # parties not allowed in the company.
+            if hasattr(Party, 'companies'):
+                PartyCompany = pool.get('party.company.rel')
+                party_company_table = PartyCompany.__table__()
+                company_query = party_company_table.select(
+                    party_company_table.party,
+                    where=party_company_table.company == company.id)
+                where &= (party_table.id.in_(company_query))
+
+            query = values.join(party_table, condition=where).select(
+                text, party_table.id)
+            cursor.execute(*query)
+            records.extend(cursor)
 
         # Use search in order for ir.rule to be applied
         with Transaction().set_context(_check_access=True):
             domain = list(Rule.domain_get(Party.__name__, mode='read') or [])
         parties = Party.search(domain + [
-                ('id', 'in', [x[0] for x in records]),
+                ('id', 'in', list({x[1] for x in records})),
                 ])
-        similars = []
+        texts_by_party = defaultdict(list)
+        for text, party_id in records:
+            texts_by_party[party_id].append(text)
+
+        # Keep the order of the parties found for the same similarity
+        similars = defaultdict(list)
         for party in parties:
-            percent = compare_party(party.name, text)
-            similars.append((party, percent))
-        return dict((x[0], x[1]) for x in sorted(similars, key=lambda x: x[1],
-            reverse=True))
+            for text in texts_by_party[party.id]:
+                similars[text].append((party, compare_party(party.name, text)))
+        return {text: dict((x[0], x[1]) for x in sorted(similars[text],
+                    key=lambda x: x[1], reverse=True))
+            for text in texts}
+
+    def _similar_parties_texts(self):
+        return self.clean_remittance_information, self.clean_counterpart_name
+
+    def _similar_parties_key(self):
+        # The user is part of the key because of the record rules
+        return (('similar_parties', Transaction().user, self.company.id)
+            + self._similar_parties_texts())
 
     def similar_parties(self):
         """
@@ -1267,20 +1422,36 @@ class Origin(Workflow, metaclass=PoolMeta):
         Additionaly, compare the creditor's or debtor's name, depending if the
         amount is positive or negative, respectively.
         If a party appears during both searches, the greatest similarity is taken
+        The result is memoized in the transaction by the texts compared.
         """
-        debtor_creditor = None
-        if self.amount > 0:
-            debtor_creditor = self.get_information_value('debtor_name')
-        elif self.amount < 0:
-            debtor_creditor = self.get_information_value('creditor_name')
-        information = self.remittance_information
-
-        parties = {}
-
-        parties = self.similar_parties_query(information)
-        for party, value in self.similar_parties_query(debtor_creditor).items():
-            parties[party] = max(parties.get(party, 0), value)
+        memo = get_memo(Transaction())
+        key = self._similar_parties_key()
+        if key not in memo:
+            self.prefetch_similar_parties([self])
+        return dict(memo[key])
 
+    @classmethod
+    def prefetch_similar_parties(cls, origins):
+        "Memoize the similar parties of the origins with one query by company"
+        memo = get_memo(Transaction())
+        to_search = defaultdict(list)
+        for origin in origins:
+            key = origin._similar_parties_key()
+            if key not in memo:
+                to_search[origin.company].append(origin)
+
+        for company, company_origins in to_search.items():
+            similars = cls.similar_parties_queries(company, chain.from_iterable(
+                    x._similar_parties_texts() for x in company_origins))
+            for origin in company_origins:
+                information, debtor_creditor = origin._similar_parties_texts()
+                parties = dict(similars.get(information, {}))
+                for party, value in similars.get(debtor_creditor, {}).items():
+                    parties[party] = max(parties.get(party, 0), value)
+                memo[origin._similar_parties_key()] = (
+                    origin._filter_similar_parties(parties))
+
+    def _filter_similar_parties(self, parties):
         if parties:
             # Discard all entries that have a similiarity below ~25% of the
             # maximum similarity. For cases where the maximum similarity is
@@ -1298,43 +1469,47 @@ class Origin(Workflow, metaclass=PoolMeta):
             # party would be picked which may be very different from the company name
             # The previous logic is to avoid that
             parties.pop(self.company.party, None)
-
         return parties
 
     def similar_origins(self):
+        """
+        Return the list of posted origins with a remittance information
+        similar to this one and their similarity, from the most similar.
+        They are looked up in the fingerprints of the posted origins.
+        """
         pool = Pool()
-        Statement = pool.get('account.statement')
         Origin = pool.get('account.statement.origin')
-        Line = pool.get('account.statement.line')
+        Fingerprint = pool.get('account.statement.origin.fingerprint')
         Rule = pool.get('ir.rule')
 
-        statement_table = Statement.__table__()
-        origin_table = Origin.__table__()
-        line_table = Line.__table__()
+        fingerprint = Fingerprint.__table__()
         cursor = Transaction().connection.cursor()
-        database = Transaction().database
 
-        ORIGIN_SIMILARITY_THRESHOLD = self.statement.journal.get_weight(
-            'origin-similarity-threshold')
-        ORIGIN_DELTA_DAYS = self.statement.journal.get_weight(
-            'origin-delta-days')
+        weights = self._get_weights()
+        ORIGIN_SIMILARITY_THRESHOLD = weights.origin_similarity_threshold
+        ORIGIN_DELTA_DAYS = weights.origin_delta_days
+
+        # The result is memoized in the transaction by the values compared
+        memo = get_memo(Transaction())
+        key = ('similar_origins', Transaction().user, self.company.id,
+            self.clean_remittance_information, self.date,
+            ORIGIN_SIMILARITY_THRESHOLD, ORIGIN_DELTA_DAYS)
+        if key in memo:
+            return list(memo[key])
 
         create_similarity()
-        similarity_column = Similarity(database.unaccent(JsonExtract(
-                origin_table.information, 'remittance_information')),
-            database.unaccent(self.remittance_information))
-        query = origin_table.join(line_table,
-            condition=origin_table.id == line_table.origin).join(
-                statement_table,
-                condition=origin_table.statement == statement_table.id).select(
-            origin_table.id, similarity_column,
-            where=((similarity_column >= ORIGIN_SIMILARITY_THRESHOLD / 100)
-                & (statement_table.company == self.company.id)
-                & (origin_table.state == 'posted')
-                & (line_table.related_to == None))
-                & (origin_table.create_date >= self.date
-                   - timedelta(days=ORIGIN_DELTA_DAYS)),
-            order_by=[similarity_column.desc]
+        text = self.clean_remittance_information
+        if not text:
+            return []
+        similarity_column = Similarity(fingerprint.text, text)
+        query = fingerprint.select(
+            fingerprint.origin, similarity_column,
+            where=(similarity_match(fingerprint.text, text,
+                    ORIGIN_SIMILARITY_THRESHOLD / 100)
+                & (fingerprint.company == self.company.id)
+                & (fingerprint.date >= self.date
+                    - timedelta(days=ORIGIN_DELTA_DAYS))),
+            order_by=[similarity_column.desc, fingerprint.origin.asc]
             )
         cursor.execute(*query)
         records = cursor.fetchall()
@@ -1344,8 +1519,9 @@ class Origin(Workflow, metaclass=PoolMeta):
         origins = Origin.search(domain + [
                 ('id', 'in', [x[0] for x in records]),
                 ])
-        similarities = [x[1] * 100 for x in records]
-        merge = list(zip(origins, similarities))
+        origins = {x.id: x for x in origins}
+        merge = [(origins[id_], similarity * 100)
+            for id_, similarity in records if id_ in origins]
         if merge:
             # Discard all entries that have a similiarity below ~25% of the
             # maximum similarity. For cases where the maximum similarity is
@@ -1354,7 +1530,8 @@ class Origin(Workflow, metaclass=PoolMeta):
             minimal = maximum - max(maximum / 4, 10)
             # Discard all entries that have a similarity below minimal
             merge = [x for x in merge if x[1] >= minimal]
-        return merge
+        memo[key] = merge
+        return list(merge)
 
     def get_suggestions_from_payments(self, payments, group_key=(), type_=''):
         """
@@ -1401,7 +1578,6 @@ class Origin(Workflow, metaclass=PoolMeta):
                 to_save.append(line)
 
         suggested_line = SuggestedLine.pack(to_save)
-        suggested_line.save()
         return [suggested_line] if suggested_line else []
 
     def get_suggestion_from_move_line(self, line):
@@ -1444,22 +1620,46 @@ class Origin(Workflow, metaclass=PoolMeta):
             to_save.append(suggested_line)
         return SuggestedLine.pack(to_save)
 
+    def _clearing_payment_group_key(self):
+        kind = 'receivable' if self.pending_amount > ZERO else 'payable'
+        return (self.currency.id, self.company.id, kind)
+
+    @classmethod
+    def _search_clearing_payment_groups(cls, currency, company, kind):
+        Group = Pool().get('account.payment.group')
+        return Group.search([
+                ('journal.currency', '=', currency),
+                ('journal.clearing_account', '!=', None),
+                ('company', '=', company),
+                ('kind', '=', kind),
+                ])
+
+    @classmethod
+    def _suggest_clearing_payment_group_batch(cls, origins, run):
+        "Search once the payment groups of each currency, company and kind"
+        batch = run.batches['clearing_payment_group'] = {}
+        for origin in origins:
+            key = origin._clearing_payment_group_key()
+            if key not in batch:
+                batch[key] = cls._search_clearing_payment_groups(*key)
+
     def _suggest_clearing_payment_group(self):
         pool = Pool()
-        Group = pool.get('account.payment.group')
         SuggestedLine = pool.get('account.statement.origin.suggested.line')
 
         if not self.pending_amount:
             return
 
         to_save = []
-        kind = 'receivable' if self.pending_amount > ZERO else 'payable'
-        for group in Group.search([
-                ('journal.currency', '=', self.currency),
-                ('journal.clearing_account', '!=', None),
-                ('company', '=', self.company.id),
-                ('kind', '=', kind),
-                ]):
+        key = self._clearing_payment_group_key()
+        run = SuggestionRun.current(Transaction())
+        batch = run.batches.get('clearing_payment_group') if run else None
+        if batch is not None and key in batch:
+            groups = batch[key]
+        else:
+            groups = self._search_clearing_payment_groups(*key)
+        self._add_candidates(len(groups))
+        for group in groups:
             if group.payment_amount != abs(self.pending_amount):
                 continue
             for payment in group.payments:
@@ -1478,37 +1678,87 @@ class Origin(Workflow, metaclass=PoolMeta):
                 suggestion.second_currency = self.second_currency
                 to_save.append(suggestion)
 
-        SuggestedLine.save(to_save)
+        self._save_suggestions(to_save)
 
-    def _suggest_clearing_payment(self):
-        pool = Pool()
-        Payment = pool.get('account.payment')
-        SuggestedLine = pool.get('account.statement.origin.suggested.line')
+    @classmethod
+    def _search_clearing_payments(cls, currency, company, amounts):
+        Payment = Pool().get('account.payment')
+        return Payment.search([
+                ('currency', '=', currency),
+                ('company', '=', company),
+                ('state', '!=', 'failed'),
+                ('journal.clearing_account', '!=', None),
+                ('clearing_move', '!=', None),
+                ('amount', 'in', amounts),
+                ])
+
+    @classmethod
+    def _suggest_clearing_payment_batch(cls, origins, run):
+        '''
+        Search once the clearing payments of the pending amounts of each
+        currency and company
+        '''
+        amounts = defaultdict(set)
+        for origin in origins:
+            if origin.pending_amount:
+                amounts[(origin.currency.id, origin.company.id)].add(
+                    origin.pending_amount)
+        batch = run.batches['clearing_payment'] = {}
+        for (currency, company), values in amounts.items():
+            for sub_values in grouped_slice(values, backend.MAX_QUERY_PARAMS):
+                for payment in cls._search_clearing_payments(
+                        currency, company, list(sub_values)):
+                    batch.setdefault((currency, company, payment.amount),
+                        []).append(payment)
 
+    def _suggest_clearing_payment(self):
         if not self.pending_amount:
             return
 
         to_save = []
-        for payment in Payment.search([
-                ('currency', '=', self.currency),
-                ('company', '=', self.company.id),
-                ('state', '!=', 'failed'),
-                ('journal.clearing_account', '!=', None),
-                ('clearing_move', '!=', None),
-                ('amount', '=', self.pending_amount),
-                ]):
+        run = SuggestionRun.current(Transaction())
+        batch = run.batches.get('clearing_payment') if run else None
+        if batch is not None:
+            payments = batch.get((self.currency.id, self.company.id,
+                    self.pending_amount), [])
+        else:
+            payments = self._search_clearing_payments(self.currency.id,
+                self.company.id, [self.pending_amount])
+        self._add_candidates(len(payments))
+        for payment in payments:
             suggested_lines = self.get_suggestions_from_payments([payment],
                 group_key=(), type_='payment')
             if suggested_lines:
                 to_save += suggested_lines
 
-        SuggestedLine.save(to_save)
+        self._save_suggestions(to_save)
 
-    def _suggest_payment(self):
-        pool = Pool()
-        Payment = pool.get('account.payment')
-        SuggestedLine = pool.get('account.statement.origin.suggested.line')
+    def _payment_key(self):
+        currency = self.second_currency or self.currency
+        return (self.company.id, currency.id)
+
+    @classmethod
+    def _search_payments(cls, company, currency):
+        Payment = Pool().get('account.payment')
+        return Payment.search([
+                ('company', '=', company),
+                ('state', '!=', 'failed'),
+                ('line', '!=', None),
+                ('line.reconciliation', '=', None),
+                ('line.account.reconcile', '=', True),
+                ('currency', '=', currency),
+                ])
+
+    @classmethod
+    def _suggest_payment_batch(cls, origins, run):
+        "Search once the pending payments of each company and currency"
+        batch = run.batches['payment'] = {}
+        for origin in origins:
+            key = origin._payment_key()
+            if key not in batch:
+                batch[key] = cls._search_payments(*key)
 
+    def _suggest_payment(self):
         amount = self.pending_amount
         if not amount:
             return
@@ -1518,18 +1768,15 @@ class Origin(Workflow, metaclass=PoolMeta):
             'amount': ZERO,
             'groups': {}
             }
-        domain = [
-            ('company', '=', self.company.id),
-            ('state', '!=', 'failed'),
-            ('line', '!=', None),
-            ('line.reconciliation', '=', None),
-            ('line.account.reconcile', '=', True),
-            ]
-        if self.second_currency:
-            domain.append(('currency', '=', self.second_currency))
+        key = self._payment_key()
+        run = SuggestionRun.current(Transaction())
+        batch = run.batches.get('payment') if run else None
+        if batch is not None and key in batch:
+            payments = batch[key]
         else:
-            domain.append(('currency', '=', self.currency))
-        for payment in Payment.search(domain):
+            payments = self._search_payments(*key)
+        self._add_candidates(len(payments))
+        for payment in payments:
             payment_amount = payment.amount
             payment_date = payment.date
             group = payment.group if payment.group else payment
@@ -1594,7 +1841,7 @@ class Origin(Workflow, metaclass=PoolMeta):
                     if suggested_lines:
                         to_save += suggested_lines
 
-        SuggestedLine.save(to_save)
+        self._save_suggestions(to_save)
 
     def _search_move_line_reconciliation_domain(self, second_currency=None):
         domain = [
@@ -1636,6 +1883,7 @@ class Origin(Workflow, metaclass=PoolMeta):
         """
         pool = Pool()
         SuggestedLine = pool.get('account.statement.origin.suggested.line')
+        Fingerprint = pool.get('account.statement.origin.fingerprint')
 
         suggested_lines = []
 
@@ -1643,21 +1891,23 @@ class Origin(Workflow, metaclass=PoolMeta):
         if not amount or not self.remittance_information or not self.company:
             return suggested_lines
 
+        similar_origins = self.similar_origins()
+        self._add_candidates(len(similar_origins))
+        fingerprints = {x.origin: x for x in Fingerprint.search([
+                    ('origin', 'in', [x.id for x, _ in similar_origins]),
+                    ])}
+
         last_similarity = 0
         to_save = []
-        for origin, similarity in self.similar_origins():
+        for origin, similarity in similar_origins:
+            if self.timed_out():
+                break
             if similarity == last_similarity:
                 continue
             last_similarity = similarity
 
-            def get_key(x):
-                return (x.account.id if x.account else -1,
-                    x.party.id if x.party else -1)
-
             suggestions = []
-            for key, group in groupby(sorted(origin.lines,
-                            key=self._suggest_origin_key),
-                        key=self._suggest_origin_key):
+            for key in fingerprints[origin].get_keys():
                 suggestion = self.get_suggestion_from_origin_key(origin, key)
                 suggestions.append(suggestion)
 
@@ -1666,37 +1916,24 @@ class Origin(Workflow, metaclass=PoolMeta):
 
             to_save.append(SuggestedLine.pack(suggestions))
 
-        SuggestedLine.save(to_save)
+        self._save_suggestions(to_save)
 
-    def _suggest_combination(self, domain, type_, based_on=None,
-            sorting='oldest'):
+    def _move_line_snapshot_key(self):
+        # Same values as used by _search_move_line_reconciliation_domain
+        return (self.company.id, self.currency.id)
+
+    def _load_move_line_snapshot(self, parties=None):
+        """
+        Return a MoveLineSnapshot with the open move lines of the
+        reconciliation domain, restricted to parties if set.
+        """
         pool = Pool()
         Move = pool.get('account.move')
         MoveLine = pool.get('account.move.line')
-        SuggestedLine = pool.get('account.statement.origin.suggested.line')
-
-        MAX_LENGTH = self.statement.journal.get_weight('move-line-max-count')
-
-        # TODO: Make DECIMALS depend on the currency
-        DECIMALS = 2
-        POWER = 10 ** DECIMALS
-        MAX_SUGGESTIONS = 100
-
-        # Converting all Decimal to int to improve performance
-        # In several tests reduced the time by 30%
-        def to_int(value):
-            return int(value * POWER)
-
-        max_tolerance = to_int(self.statement.journal.max_amount_tolerance)
-
-        # TODO: Add support for second_currency
-        amount = to_int(self.pending_amount)
-        if not amount:
-            return
-
-        if self.escape():
-            return
 
+        domain = self._search_move_line_reconciliation_domain()
+        if parties is not None:
+            domain.append(('party', 'in', parties))
         # Use search in order for ir.rule to be applied
         with Transaction().set_context(_check_access=True):
             subquery = MoveLine.search(domain, query=True)
@@ -1708,56 +1945,98 @@ class Origin(Workflow, metaclass=PoolMeta):
         query = query.select(
             move_line.id,
             move_line.debit - move_line.credit,
-            where=move_line.id.in_(subquery))
-
-        if sorting == 'oldest':
-            query.order_by = [Coalesce(move_line.maturity_date, move.date).asc]
-        else: # sorting == 'closest'
-            query.order_by = [Abs(Literal(self.date) - Coalesce(move_line.maturity_date, move.date)).asc]
+            move_line.party,
+            move_line.maturity_date,
+            move.date,
+            where=move_line.id.in_(subquery),
+            order_by=[move_line.id.asc])
 
         cursor = Transaction().connection.cursor()
         cursor.execute(*query)
-        lines = cursor.fetchall()
+        # Coalesce the dates in Python because SQLite returns the result of
+        # COALESCE as string instead of date
+        return MoveLineSnapshot(
+            (id_, to_int(amount), party, maturity_date or date)
+            for id_, amount, party, maturity_date, date in cursor)
+
+    def _get_combination_candidates(self, parties=None):
+        """
+        Return the (id, amount, date) of the move lines that can be combined,
+        with the amount converted by to_int.
+        During search_suggestions all the open move lines of the same
+        company and currency are loaded once, in a snapshot shared by all
+        the origins, and filtered by parties in memory. If the combinations
+        of all the lines are not searched, only the lines of the parties are
+        loaded.
+        """
+        if parties is not None:
+            parties = sorted({int(x) for x in parties})
+        run = SuggestionRun.current(Transaction())
+        if run is None:
+            return self._load_move_line_snapshot(parties).select()
+        key = self._move_line_snapshot_key()
+        if (parties is not None
+                and not self._get_weights().type_weight('combination-all')):
+            snapshot = run.get_snapshot(key + (tuple(parties),),
+                lambda: self._load_move_line_snapshot(parties))
+            return snapshot.select()
+        snapshot = run.get_snapshot(key, self._load_move_line_snapshot)
+        return snapshot.select(parties)
+
+    def _suggest_combination(self, candidates, type_, based_on=None,
+            sorting='oldest'):
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+
+        weights = self._get_weights()
+        MAX_LENGTH = weights.move_line_max_count
+        MAX_SUGGESTIONS = 100
+
+        max_tolerance = to_int(self.statement.journal.max_amount_tolerance)
+
+        # TODO: Add support for second_currency
+        amount = to_int(self.pending_amount)
+        if not amount:
+            return
+
+        if self.escape() or self.timed_out():
+            return
+
+        lines = candidates
         if not lines:
             return
+        self._add_candidates(len(lines))
+
+        if sorting == 'oldest':
+            lines = sorted(lines, key=lambda x: x[2])
+        else: # sorting == 'closest'
+            lines = sorted(lines, key=lambda x: abs(self.date - x[2]))
 
-        target_combinations = self.journal.get_weight('target-combinations')
+        target_combinations = weights.target_combinations
+        deadline = self._get_search().deadline
 
         suggestions = []
-        lines = tuple((x[0], to_int(x[1])) for x in lines)
-        for length in range(1, min(MAX_LENGTH, len(lines)) + 1):
-            if length > len(lines):
+        lines = tuple((x[0], x[1]) for x in lines)
+        # The whole list of lines is searched, target_combinations is the
+        # maximum number of partial combinations visited for each length
+        for combination in find_combinations(lines, amount,
+                tolerance=max_tolerance, max_length=MAX_LENGTH,
+                budget=target_combinations,
+                first_only=(type_ == 'combination-party'),
+                deadline=deadline.at if deadline else None,
+                processes=COMBINATION_PROCESSES, limit=MAX_SUGGESTIONS):
+            suggestions.append(self.get_suggestion_from_move_lines(
+                MoveLine.browse([x[0] for x in combination]), type_,
+                based_on=based_on))
+            if self.escape() or self.timed_out():
                 break
-            if length == 1:
-                candidates = lines
-            else:
-                l = candidate_size(length, target_combinations)
-                candidates = lines[:l]
-            for combination in combinations(candidates, length):
-                total_amount = sum(x[1] for x in combination)
-                if abs(total_amount - amount) <= max_tolerance:
-                    suggestions.append(self.get_suggestion_from_move_lines(
-                        MoveLine.browse([x[0] for x in combination]), type_,
-                        based_on=based_on))
-
-                    if type_ == 'combination-party':
-                        break
-                    if self.escape():
-                        return
-                    if len(suggestions) >= MAX_SUGGESTIONS:
-                        # Even if we want to find all suggestions
-                        # so later they will be sorted by weight, we cannot
-                        # spend too much time and need to set a limit
-                        return
-            # If we already found some lines we want to quit. The
-            # larger the number of combinations, the sooner we want to
-            # quit because the probability of finding a good
-            # combination is lower and the computational cost not worth
-            # it
-            #if len(to_save) >= (MAX_LENGTH - length) / 5:
-                #return
-
-        SuggestedLine.save(suggestions)
+            if len(suggestions) >= MAX_SUGGESTIONS:
+                # Even if we want to find all suggestions
+                # so later they will be sorted by weight, we cannot
+                # spend too much time and need to set a limit
+                break
+
+        self._save_suggestions(suggestions)
 
     def _suggest_similar_parties(self):
         Party = Pool().get('party.party')
@@ -1768,24 +2047,23 @@ class Origin(Workflow, metaclass=PoolMeta):
                             similar_origin.lines if x.party))))
 
         for parties in similar_parties:
+            if self.timed_out():
+                break
             parties = Party.browse(parties)
-            domain = self._search_move_line_reconciliation_domain()
-            domain.append(('party', 'in', parties))
+            candidates = self._get_combination_candidates(parties)
             # Execute closest first because it can rank better
-            self._suggest_combination(domain, 'combination-party',
+            self._suggest_combination(candidates, 'combination-party',
                 sorting='closest')
-            self._suggest_combination(domain, 'combination-party',
+            self._suggest_combination(candidates, 'combination-party',
                 sorting='oldest')
 
     def _suggest_combination_all(self):
-        # This suggestion could be very time-consuming, so only execute it if
-        # the weight is non-zero
-        if not self.journal.get_weight('type-combination-all'):
-            return
-        domain = self._search_move_line_reconciliation_domain()
+        candidates = self._get_combination_candidates()
         # Execute closest first because it can rank better
-        self._suggest_combination(domain, 'combination-all', sorting='closest')
-        self._suggest_combination(domain, 'combination-all', sorting='oldest')
+        self._suggest_combination(candidates, 'combination-all',
+            sorting='closest')
+        self._suggest_combination(candidates, 'combination-all',
+            sorting='oldest')
 
     def _suggest_balance(self):
         pool = Pool()
@@ -1809,7 +2087,7 @@ class Origin(Workflow, metaclass=PoolMeta):
         else:
             suggested_line.account = party.account_payable_used
         suggested_line.date = self.date
-        suggested_line.save()
+        self._save_suggestions([suggested_line])
 
     def _suggest_balance_old_invoices(self):
         pool = Pool()
@@ -1826,11 +2104,13 @@ class Origin(Workflow, metaclass=PoolMeta):
 
         amount = self.pending_amount
         suggestions = []
-        for invoice in Invoice.search([
+        invoices = Invoice.search([
                 ('company', '=', self.company.id),
                 ('party', '=', party.id),
                 ('state', '=', 'posted'),
-                ], order=[('invoice_date', 'ASC')]):
+                ], order=[('invoice_date', 'ASC')])
+        self._add_candidates(len(invoices))
+        for invoice in invoices:
             amount_to_pay = invoice.amount_to_pay
             if invoice.type == 'in':
                 amount_to_pay *= -1
@@ -1871,7 +2151,7 @@ class Origin(Workflow, metaclass=PoolMeta):
             suggestions.append(suggestion)
 
         suggestion = SuggestedLine.pack(suggestions)
-        suggestion.save()
+        self._save_suggestions([suggestion])
 
     def _suggest_sale(self):
         try:
@@ -1883,6 +2163,7 @@ class Origin(Workflow, metaclass=PoolMeta):
                 ('party', 'in', list(self.similar_parties().keys())[:5]),
                 ('state', 'in', ('quotation', 'confirmed', 'processing')),
                 ], order=[('sale_date', 'ASC')])
+        self._add_candidates(len(sales))
         for sale in sales:
             if sale.total_amount != self.pending_amount:
                 continue
@@ -1907,32 +2188,196 @@ class Origin(Workflow, metaclass=PoolMeta):
             suggested_line.account = sale.party.account_receivable_used
             suggested_line.amount = min(self.pending_amount, sale.total_amount)
             suggested_line.date = self.date
-            suggested_line.save()
+            self._save_suggestions([suggested_line])
 
     def merge_suggestions(self):
         SuggestedLine = Pool().get('account.statement.origin.suggested.line')
         SuggestedLine.merge_suggestions(self.suggested_lines_tree)
 
-    def escape(self):
+    def _save_suggestions(self, suggestions):
+        "Save the suggestions and keep track of their weight for escape()"
         SuggestedLine = Pool().get('account.statement.origin.suggested.line')
 
-        lines = SuggestedLine.search([
-                ('origin', '=', self),
-                ('parent', '=', None),
-                ('state', '=', 'proposed'),
-                ], order=[('weight', 'DESC')])
-        if not lines:
-            return False
-        ESCAPE = self.statement.journal.get_weight('escape-threshold')
-        if lines[0].weight > ESCAPE:
-            return True
-        COMBINATION_ESCAPE = self.statement.journal.get_weight(
-            'combination-escape-threshold')
-        for line in lines:
-            if (line.type.startswith('combination')
-                    and line.weight >= COMBINATION_ESCAPE):
-                return True
-        return False
+        suggestions = [x for x in suggestions if x]
+        if not suggestions:
+            return
+        search = self._get_search()
+        stat = search.strategy_stat
+        if stat:
+            stat.suggestions += len(suggestions)
+            for suggestion in suggestions:
+                suggestion.strategy = stat.strategy
+                for child in getattr(suggestion, 'childs', None) or []:
+                    child.strategy = stat.strategy
+        SuggestedLine.compute_weights(suggestions, search.weights)
+        if search.new_suggestions is not None:
+            # search_suggestions saves the best ones at once with
+            # _refresh_suggestions
+            for suggestion in suggestions:
+                suggestion.identity = suggestion.get_identity()
+                search.new_suggestions.add(suggestion.identity,
+                    suggestion.weight, suggestion)
+        else:
+            with Transaction().set_context(_suggestion_weighted=True):
+                SuggestedLine.save(suggestions)
+        tracker = search.escape_tracker
+        for suggestion in suggestions:
+            if suggestion.state == 'proposed':
+                tracker.add(suggestion.type, suggestion.weight)
+
+    def _get_watches(self):
+        '''
+        Return the (kind, value) of the ledger items whose appearance may
+        give new suggestions to the origin
+        '''
+        Watch = Pool().get('account.statement.origin.watch')
+
+        if not self.pending_amount:
+            return set()
+        watches = {('amount',
+                Watch.amount_value(self.pending_amount, self.currency))}
+        for party in list(self.similar_parties())[:5]:
+            watches.add(('party', Watch.party_value(party)))
+        for value in Watch.reference_values(
+                self.clean_remittance_information):
+            watches.add(('reference', value))
+        return watches
+
+    def _refresh_suggestions(self, suggestions):
+        '''
+        Replace the suggestions of the origin by the new suggestions writing
+        only the differences: the ones with a new identity are created, the
+        ones not suggested anymore are deleted and the others are only
+        written if their weight, type or strategy changed or they were used.
+        The suggestions with the same identity are merged keeping the one
+        with the greatest weight.
+        Return the stored suggestions from the greatest weight.
+        '''
+        SuggestedLine = Pool().get('account.statement.origin.suggested.line')
+
+        new = {}
+        for suggestion in sorted(suggestions, key=lambda x: x.weight,
+                reverse=True):
+            if not getattr(suggestion, 'identity', None):
+                suggestion.identity = suggestion.get_identity()
+            new.setdefault(suggestion.identity, suggestion)
+
+        to_delete = []
+        to_save = []
+        lines = []
+        for line in SuggestedLine.search([
+                    ('origin', '=', self.id),
+                    ('parent', '=', None),
+                    ]):
+            suggestion = new.pop(line.identity or line.get_identity(), None)
+            if suggestion is None:
+                to_delete += line.childs
+                to_delete.append(line)
+            else:
+                to_save += line.update_from(suggestion)
+                lines.append(line)
+        to_save += new.values()
+        lines += new.values()
+
+        if to_delete:
+            SuggestedLine.delete(to_delete)
+        if to_save:
+            with Transaction().set_context(_suggestion_weighted=True):
+                SuggestedLine.save(to_save)
+        return sorted(lines, key=lambda x: x.weight, reverse=True)
+
+    def _get_search(self):
+        '''
+        Return the OriginSearch of the origin in the started SuggestionRun or
+        a new one if there is no run
+        '''
+        run = SuggestionRun.current(Transaction())
+        search = run.searches.get(self.id) if run else None
+        if search is None:
+            search = OriginSearch(self.statement.journal.get_weight_profile())
+            if run:
+                run.searches[self.id] = search
+        return search
+
+    def _get_weights(self):
+        "Return the WeightProfile of the journal used by the search"
+        return self._get_search().weights
+
+    def escape(self):
+        return self._get_search().escape_tracker.escape()
+
+    def timed_out(self):
+        "Return if the suggestion-time-limit of the origin is exhausted"
+        deadline = self._get_search().deadline
+        return deadline is not None and deadline.expired()
+
+    @classmethod
+    def _suggestion_strategies(cls):
+        '''
+        Return the registry of the Strategy of search_suggestions in their
+        default order. Modules add or replace strategies by extending it.
+        '''
+        return [
+            Strategy('clearing_payment_group', batch=True,
+                weight_type='payment-group'),
+            Strategy('clearing_payment', batch=True, weight_type='payment'),
+            Strategy('payment', batch=True, weight_type='payment-group'),
+            Strategy('balance', weight_type='balance'),
+            Strategy('balance_old_invoices', 'expensive',
+                weight_type='balance-invoice'),
+            Strategy('origin', weight_type='origin'),
+            # Combinations could be very time-consuming, so each one is
+            # limited to leave time to the other strategies
+            Strategy('similar_parties', 'expensive',
+                weight_type='combination-party', budget=20_000),
+            Strategy('combination_all', 'expensive',
+                weight_type='combination-all', budget=20_000),
+            Strategy('sale', 'expensive', weight_type='sale'),
+            ]
+
+    def _get_strategies(self):
+        '''
+        Return the Strategy to run ordered by the expected used suggestions
+        per second of the journal if SUGGESTION_STATS is set. The strategies
+        without enough statistics run first, in the default order, to gather
+        them. The expensive strategies whose type weighs 0 are not run.
+        '''
+        Stat = Pool().get('account.statement.origin.suggestion.stat')
+        scores = get_memo(Transaction()).setdefault('strategy_scores', {})
+        journal = self.journal
+        if journal.id not in scores:
+            scores[journal.id] = (
+                Stat.get_scores(journal) if SUGGESTION_STATS else {})
+        journal_scores = scores[journal.id]
+        weights = self._get_weights()
+        strategies = [x for x in self._suggestion_strategies()
+            if x.cost != 'expensive' or not x.weight_type
+            or weights.type_weight(x.weight_type)]
+        return sorted(strategies, key=lambda x: (
+                x.name in journal_scores, -journal_scores.get(x.name, 0)))
+
+    def _add_candidates(self, count):
+        "Add count to the candidates examined by the running strategy"
+        stat = self._get_search().strategy_stat
+        if stat:
+            stat.candidates += count
+
+    def _run_strategy(self, strategy):
+        "Run the Strategy within its budget and return its StrategyStat"
+        stat = StrategyStat(strategy.name)
+        transaction = Transaction() if SUGGESTION_QUERY_STATS else None
+        search = self._get_search()
+        deadline = search.deadline
+        if strategy.budget:
+            search.deadline = (deadline or Deadline(0)).limit(strategy.budget)
+        search.strategy_stat = stat
+        try:
+            with stat.measure(transaction):
+                getattr(self, '_suggest_' + strategy.name)()
+        finally:
+            search.strategy_stat = None
+            search.deadline = deadline
+        return stat
 
     @classmethod
     @ModelView.button
@@ -1940,6 +2385,8 @@ class Origin(Workflow, metaclass=PoolMeta):
         pool = Pool()
         SuggestedLine = pool.get('account.statement.origin.suggested.line')
         StatementLine = pool.get('account.statement.line')
+        Stat = pool.get('account.statement.origin.suggestion.stat')
+        Watch = pool.get('account.statement.origin.watch')
 
         if not origins:
             return
@@ -1949,10 +2396,13 @@ class Origin(Workflow, metaclass=PoolMeta):
         #to post the origin while the suggestion search is not finished.
         #Without the lock this could be done and after the suggestion save
         #the lines detected and break the pending_amount == 0.
+        #Only the rows of the origins are locked, so the searches of other
+        #origins run in parallel and post waits on the write of their state.
         cls.lock(origins)
 
-        # Before a new search remove all suggested lines, but control if any
-        # of them are related to a statement line.
+        # The suggested lines not found again are removed by
+        # _refresh_suggestions, but control if any of them are related to a
+        # statement line.
         suggestions = SuggestedLine.search([
                 ('origin', 'in', origins),
                 ])
@@ -1968,65 +2418,117 @@ class Origin(Workflow, metaclass=PoolMeta):
                         'msg_suggested_line_related_to_statement_line',
                         origins_name=origins_name))
 
-        SuggestedLine.delete(suggestions)
-
-        count = 0
+        if SUGGESTION_STATS:
+            Stat.delete(Stat.search([
+                        ('origin', 'in', [x.id for x in origins]),
+                        ]))
+
+        # Similar parties and origins are searched again on each run
+        get_memo(Transaction()).clear()
+        cls.prefetch_similar_parties([x for x in origins
+                if x.pending_amount != ZERO])
+        # All the origins share the same open move lines snapshot and the
+        # results of the batch strategies
         to_use = []
-        for origin in origins:
-            count += 1
-            if origin.pending_amount == ZERO:
-                continue
+        with SuggestionRun.start(Transaction()) as run:
+            pending = [x for x in origins if x.pending_amount != ZERO]
+            if pending:
+                for strategy in cls._suggestion_strategies():
+                    if strategy.batch:
+                        getattr(cls, '_suggest_%s_batch' % strategy.name)(
+                            pending, run)
 
-            origin._suggest_clearing_payment_group()
-            origin._suggest_clearing_payment()
-            origin._suggest_payment()
-            origin._suggest_balance()
-            origin._suggest_balance_old_invoices()
-            origin._suggest_origin()
-            origin._suggest_similar_parties()
-            origin._suggest_combination_all()
-            origin._suggest_sale()
-
-            ORIGIN_SIMILARITY = origin.statement.journal.get_weight(
-                'origin-similarity')
-
-            origin.merge_suggestions()
-            best = SuggestedLine.search([
-                    ('origin', '=', origin),
-                    ('parent', '=', None),
-                    ('weight', '>=', ORIGIN_SIMILARITY)
-                    ], order=[('weight', 'DESC')], limit=2)
-            if not best:
-                continue
-            first = best[0]
-            second = best[-1]
-            # Only use the first suggestion if it has a greater weight than the
-            # second one
-            if first == second or first.weight > second.weight:
-                to_use.append(first)
+            for origin in origins:
+                if origin.pending_amount == ZERO:
+                    origin._refresh_suggestions([])
+                    continue
 
+                search = origin._get_search()
+                weights = search.weights
+                # Strategies stop cooperatively once the time limit is
+                # reached and the suggestions found so far are kept
+                search.deadline = Deadline(weights.suggestion_time_limit)
+                # Only the best suggestions found are kept in memory to write
+                # the differences with the previous search
+                search.new_suggestions = TopSuggestions(
+                    weights.max_suggestion_count)
+                stats = []
+                for strategy in origin._get_strategies():
+                    if origin.timed_out():
+                        break
+                    # Once a suggestion escapes the search, the expensive
+                    # strategies are only run if they may find a better one
+                    if (strategy.cost == 'expensive' and origin.escape()
+                            and weights.max_weight(strategy.weight_type)
+                            < search.escape_tracker.best):
+                        continue
+                    stats.append(origin._run_strategy(strategy))
+
+                ORIGIN_SIMILARITY = weights.origin_similarity
+
+                lines = origin._refresh_suggestions(
+                    search.new_suggestions.items())
+                search.new_suggestions = None
+                if SUGGESTION_STATS:
+                    Stat.record(origin, stats)
+                best = [x for x in lines[:2]
+                    if x.weight >= ORIGIN_SIMILARITY]
+                if not best:
+                    continue
+                first = best[0]
+                second = best[-1]
+                # Only use the first suggestion if it has a greater weight
+                # than the second one
+                if first == second or first.weight > second.weight:
+                    to_use.append(first)
+
+        Watch.update_origins(origins)
         if to_use:
             SuggestedLine.use(to_use)
 
-        max_suggestions = origin.journal.get_weight('max-suggestion-count')
-        # Trim remaining suggestions to a max of the best <max_suggestions>
-        origins_to_save = []
-        for origin in origins:
-            if len(origin.suggested_lines_tree) <= max_suggestions:
-                continue
-            parent_suggestions = SuggestedLine.search([
-                    ('origin', '=', origin),
-                    ('parent', '=', None),
-                    ], order=[('weight', 'DESC')], limit=10)
-            child_suggestions = SuggestedLine.search([
-                    ('origin', '=', origin),
-                    ('parent', 'in', [x.id for x in parent_suggestions]),
-                    ])
-            origin.suggested_lines = parent_suggestions + child_suggestions
-            origins_to_save.append(origin)
+    @classmethod
+    def enqueue_search_suggestions(cls, origins):
+        '''
+        Queue the suggestion search of the origins in tasks of up to
+        SUGGESTION_CHUNK_SIZE origins of the same journal, which share the
+        move line snapshot and the similarity searches.
+        '''
+        def key(origin):
+            return origin.journal.id
+
+        with Transaction().set_context(queue_name=QUEUE_NAME):
+            for _, journal_origins in groupby(
+                    sorted(origins, key=key), key=key):
+                for chunk in grouped_slice(list(journal_origins),
+                        count=SUGGESTION_CHUNK_SIZE):
+                    cls.__queue__.search_suggestions_chunk(list(chunk))
 
-        if origins_to_save:
-            cls.save(origins_to_save)
+    @classmethod
+    def search_suggestions_chunk(cls, origins):
+        '''
+        Search the suggestions of a chunk of origins queued by
+        enqueue_search_suggestions.
+        If the search fails, each origin is queued alone in a separate
+        transaction before failing the chunk, so one origin can not prevent
+        the others from getting their suggestions.
+        '''
+        if len(origins) <= 1:
+            cls.search_suggestions(origins)
+            return
+        # The first lock raises a TransactionError for the queue to restart
+        # the task with the rows locked
+        cls.lock(origins)
+        try:
+            cls.search_suggestions(origins)
+        except (TransactionError, backend.DatabaseOperationalError):
+            # Let the queue restart or retry the whole chunk
+            raise
+        except Exception:
+            with Transaction().new_transaction(), \
+                    Transaction().set_context(queue_name=QUEUE_NAME):
+                for origin in origins:
+                    cls.__queue__.search_suggestions_chunk([origin.id])
+            raise
 
     @classmethod
     def _get_statement_line(cls, origin, related=None, party=None,
@@ -2187,7 +2689,12 @@ class Origin(Workflow, metaclass=PoolMeta):
         pool = Pool()
         Statement = pool.get('account.statement')
         StatementLine = pool.get('account.statement.line')
+        Fingerprint = pool.get('account.statement.origin.fingerprint')
+        Stat = pool.get('account.statement.origin.suggestion.stat')
+        Watch = pool.get('account.statement.origin.watch')
 
+        # The posted origins do not wait for their moves
+        Watch.delete_origins(origins)
         cls.find_same_related_origin(origins)
         cls.validate_origin(origins)
         cls.create_moves(origins)
@@ -2221,15 +2728,23 @@ class Origin(Workflow, metaclass=PoolMeta):
         if statements_to_post:
             Statement.write(statements_to_post, {'state': 'posted'})
 
+        Fingerprint.update_origins(origins)
+        Stat.mark([x.suggested_line.parent or x.suggested_line
+                for x in lines if x.suggested_line], 'posted')
+
     @classmethod
     @ModelView.button
     @Workflow.transition('cancelled')
     def cancel(cls, origins):
         pool = Pool()
         StatementLine = pool.get('account.statement.line')
+        Fingerprint = pool.get('account.statement.origin.fingerprint')
+        Watch = pool.get('account.statement.origin.watch')
 
         lines = [x for origin in origins for x in origin.lines]
         StatementLine.cancel_lines(lines)
+        Fingerprint.delete_origins(origins)
+        Watch.delete_origins(origins)
 
     @classmethod
     def find_same_related_origin(cls, origins):
@@ -2303,6 +2818,322 @@ class Origin(Workflow, metaclass=PoolMeta):
             ]
 
 
+class OriginFingerprint(ModelSQL):
+    'Account Statement Origin Fingerprint'
+    __name__ = 'account.statement.origin.fingerprint'
+
+    origin = fields.Many2One('account.statement.origin', "Origin",
+        required=True, ondelete='CASCADE')
+    company = fields.Many2One('company.company', "Company", required=True)
+    date = fields.Date("Date", required=True)
+    text = fields.Char("Text")
+    keys = fields.Text("Keys",
+        help="The JSON list of the keys of the origin lines given by "
+        "_suggest_origin_key.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('origin_uniq', Unique(t, t.origin),
+                'account_statement_enable_banking.'
+                'msg_origin_fingerprint_unique'),
+            ]
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.company, Index.Equality()),
+                    (t.date, Index.Range())),
+                Index(t, (t.text, Index.Similarity())),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Origin = pool.get('account.statement.origin')
+        Line = pool.get('account.statement.line')
+        Statement = pool.get('account.statement')
+
+        exist = backend.TableHandler.table_exist(cls._table)
+
+        super().__register__(module_name)
+
+        if not exist:
+            # Fill the posted origins, their keys are computed when needed
+            table = cls.__table__()
+            origin = Origin.__table__()
+            line = Line.__table__()
+            statement = Statement.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.insert(
+                    [table.origin, table.company, table.date, table.text],
+                    origin.join(statement,
+                        condition=origin.statement == statement.id).select(
+                        origin.id, statement.company, origin.date,
+                        origin.clean_remittance_information,
+                        where=(origin.state == 'posted')
+                        & origin.id.in_(line.select(line.origin,
+                                where=line.related_to == Null)))))
+
+    @classmethod
+    def update_origins(cls, origins):
+        "Replace the fingerprints of the origins by their current values"
+        to_create = []
+        for origin in origins:
+            # Only the origins with lines not related to a document can be
+            # reproduced by _suggest_origin
+            if not any(not x.related_to for x in origin.lines):
+                continue
+            to_create.append({
+                    'origin': origin.id,
+                    'company': origin.company.id,
+                    'date': origin.date,
+                    'text': origin.clean_remittance_information,
+                    'keys': cls._dump_keys(origin),
+                    })
+        cls.delete_origins(origins)
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def delete_origins(cls, origins):
+        cls.delete(cls.search([
+                    ('origin', 'in', [x.id for x in origins]),
+                    ]))
+
+    @staticmethod
+    def _dump_keys(origin):
+        return json.dumps(sorted({origin._suggest_origin_key(x)
+                    for x in origin.lines}))
+
+    def get_keys(self):
+        "Return the sorted keys of the origin lines"
+        if self.keys is None:
+            self.keys = self._dump_keys(self.origin)
+            self.save()
+
+        def to_tuple(value):
+            if isinstance(value, list):
+                return tuple(to_tuple(x) for x in value)
+            return value
+        return [to_tuple(x) for x in json.loads(self.keys)]
+
+
+class OriginSuggestionStat(ModelSQL):
+    'Account Statement Origin Suggestion Stat'
+    __name__ = 'account.statement.origin.suggestion.stat'
+
+    origin = fields.Many2One('account.statement.origin', "Origin",
+        required=True, ondelete='CASCADE')
+    journal = fields.Many2One('account.statement.journal', "Journal",
+        required=True, ondelete='CASCADE')
+    strategy = fields.Char("Strategy", required=True)
+    duration = fields.Float("Duration", required=True,
+        help="The wall time of the strategy in seconds.")
+    queries = fields.Integer("Queries", required=True)
+    candidates = fields.Integer("Candidates", required=True,
+        help="The records examined by the strategy.")
+    suggestions = fields.Integer("Suggestions", required=True)
+    used = fields.Boolean("Used",
+        help="A suggestion of the strategy is used.")
+    posted = fields.Boolean("Posted",
+        help="The origin is posted with a suggestion of the strategy.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.origin, Index.Equality()),
+                    (t.strategy, Index.Equality())),
+                Index(t, (t.journal, Index.Equality())),
+                })
+
+    @staticmethod
+    def default_used():
+        return False
+
+    @staticmethod
+    def default_posted():
+        return False
+
+    @classmethod
+    def record(cls, origin, stats):
+        "Store the StrategyStat of the search_suggestions of origin"
+        cls.create([{
+                    'origin': origin.id,
+                    'journal': origin.journal.id,
+                    'strategy': x.strategy,
+                    'duration': x.duration,
+                    'queries': x.queries,
+                    'candidates': x.candidates,
+                    'suggestions': x.suggestions,
+                    } for x in stats])
+
+    @classmethod
+    def get_scores(cls, journal):
+        '''
+        Return the expected used suggestions per second of each strategy of
+        journal with at least STRATEGY_MIN_RUNS runs
+        '''
+        stat = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        runs = Count(Literal('*'))
+        cursor.execute(*stat.select(
+                stat.strategy,
+                runs,
+                Sum(stat.duration),
+                Sum(Case((stat.used | stat.posted, 1), else_=0)),
+                where=stat.journal == journal.id,
+                group_by=[stat.strategy],
+                having=runs >= STRATEGY_MIN_RUNS))
+        scores = {}
+        for strategy, runs, duration, hits in cursor:
+            # Smooth the hit rate so strategies never used are still ordered
+            # by their duration
+            rate = (hits + 1) / (runs + 2)
+            scores[strategy] = rate / max(duration / runs, 1e-6)
+        return scores
+
+    @classmethod
+    def mark(cls, suggestions, name, value=True):
+        "Set name to value on the stats of the strategies of suggestions"
+        keys = {(x.origin.id, x.strategy) for x in suggestions if x.strategy}
+        if not keys:
+            return
+        domain = ['OR']
+        for origin, strategy in keys:
+            domain.append([
+                    ('origin', '=', origin),
+                    ('strategy', '=', strategy),
+                    ])
+        stats = cls.search(domain)
+        if stats:
+            cls.write(stats, {name: value})
+
+
+class OriginWatch(ModelSQL):
+    '''
+    Account Statement Origin Watch
+
+    The ledger items a registered origin is waiting on: the search of its
+    suggestions is queued again when an invoice, a payment or a move with
+    any of them appears.
+    '''
+    __name__ = 'account.statement.origin.watch'
+
+    origin = fields.Many2One('account.statement.origin', "Origin",
+        required=True, ondelete='CASCADE')
+    kind = fields.Selection([
+            ('party', "Party"),
+            ('amount', "Amount"),
+            ('reference', "Reference"),
+            ], "Kind", required=True)
+    value = fields.Char("Value", required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.kind, Index.Equality()),
+                    (t.value, Index.Equality())),
+                Index(t, (t.origin, Index.Equality())),
+                })
+
+    @staticmethod
+    def party_value(party):
+        return str(int(party))
+
+    @staticmethod
+    def amount_value(amount, currency):
+        # Debits and credits wait on the same amount
+        return '%s:%s' % (int(currency), abs(amount).normalize())
+
+    @staticmethod
+    def reference_values(text):
+        '''
+        Return the words of text with digits which may be a document number,
+        excluding the years and the numbers of less than 4 digits which are
+        in too many documents
+        '''
+        if not text:
+            return set()
+        values = set()
+        for word in clean_string(text).split():
+            if len(word) < 3 or not any(c.isdigit() for c in word):
+                continue
+            if word.isdigit():
+                number = word.lstrip('0')
+                if len(number) < 4 or (
+                        len(word) == 4 and 1900 <= int(word) <= 2099):
+                    continue
+            values.add(word)
+        return values
+
+    @classmethod
+    def update_origins(cls, origins):
+        "Replace the watches of the origins by the ones of their last search"
+        to_create = []
+        for origin in origins:
+            if origin.state != 'registered':
+                continue
+            to_create += [{
+                    'origin': origin.id,
+                    'kind': kind,
+                    'value': value,
+                    } for kind, value in origin._get_watches()]
+        cls.delete_origins(origins)
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def delete_origins(cls, origins):
+        cls.delete(cls.search([
+                    ('origin', 'in', [x.id for x in origins]),
+                    ]))
+
+    @classmethod
+    def notify(cls, watches):
+        '''
+        Queue the suggestion search of the registered origins waiting on any
+        of the (kind, value) watches, once per transaction
+        '''
+        Origin = Pool().get('account.statement.origin')
+
+        values = defaultdict(set)
+        for kind, value in watches:
+            values[kind].add(value)
+        if not values:
+            return
+        domain = ['OR']
+        for kind, kind_values in values.items():
+            domain.append([
+                    ('kind', '=', kind),
+                    ('value', 'in', list(kind_values)),
+                    ])
+        watches = cls.search(domain)
+        references = Counter(
+            x.value for x in watches if x.kind == 'reference')
+        notified = get_memo(Transaction()).setdefault('notified_origins', set())
+        origins = set()
+        for watch in watches:
+            if (watch.kind == 'reference'
+                    and references[watch.value] > MAX_REFERENCE_WATCHES):
+                continue
+            origin = watch.origin
+            if (origin.id not in notified
+                    and origin.state == 'registered'
+                    and origin.journal.search_suggestions):
+                notified.add(origin.id)
+                origins.add(origin)
+        if origins:
+            Origin.enqueue_search_suggestions(list(origins))
+
+
 class OriginSuggestedLine(Workflow, ModelSQL, ModelView, tree()):
     'Account Statement Origin Suggested Line'
     __name__ = 'account.statement.origin.suggested.line'
@@ -2410,6 +3241,11 @@ class OriginSuggestedLine(Workflow, ModelSQL, ModelView, tree()):
             ('used', "Used"),
             ], "State", readonly=True, sort=False)
     based_on = fields.Many2One('account.statement.origin', 'Based On')
+    strategy = fields.Char("Strategy", readonly=True,
+        help="The strategy of the suggestion search which found it.")
+    identity = fields.Char("Identity", readonly=True,
+        help="The hash of the key of the suggestion, used to refresh the "
+        "suggestions of an origin without recreating them.")
 
     @classmethod
     def __setup__(cls):
@@ -2516,58 +3352,79 @@ class OriginSuggestedLine(Workflow, ModelSQL, ModelView, tree()):
     @ModelView.button
     @Workflow.transition('proposed')
     def propose(cls, recomended):
-        pass
+        Stat = Pool().get('account.statement.origin.suggestion.stat')
+        Stat.mark(recomended, 'used', False)
+
+    @classmethod
+    def _weight_fields(cls):
+        "Return the fields used by update_weight"
+        return {'type', 'parent', 'childs', 'origin', 'date', 'party',
+            'related_to', 'based_on'}
 
     @classmethod
     def create(cls, vlist):
         suggestions = super().create(vlist)
-        for suggestion, values in zip(suggestions, vlist):
-            if 'weight' not in values.keys():
-                suggestion.update_weight()
+        # The suggestions saved by the search already have their weight
+        # computed by compute_weights
+        if Transaction().context.get('_suggestion_weighted'):
+            return suggestions
+        for suggestion in suggestions:
+            suggestion.update_weight()
         cls.save(suggestions)
         return suggestions
 
     @classmethod
     def write(cls, *args):
         super().write(*args)
+        if Transaction().context.get('_suggestion_weighted'):
+            return
         actions = iter(args)
         to_save = []
+        weight_fields = cls._weight_fields()
         for suggestions, values in zip(actions, actions):
-            if 'weight' not in values.keys():
+            if 'weight' not in values and weight_fields & values.keys():
                 for suggestion in suggestions:
                     suggestion.update_weight()
                     to_save.append(suggestion)
         cls.save(to_save)
 
-    def update_weight(self):
-        pool = Pool()
-        Invoice = pool.get('account.invoice')
-        MoveLine = pool.get('account.move.line')
-        Payment = pool.get('account.payment')
-        try:
-            Sale = pool.get('sale.sale')
-        except KeyError:
-            Sale = None
-
+    @classmethod
+    def compute_weights(cls, suggestions, weights=None):
+        '''
+        Set in memory the weight of the suggestion trees, the children first
+        and then their parent, so they are inserted with their final weight
+        '''
+        for suggestion in suggestions:
+            suggestion._set_missing_fields()
+            for child in suggestion.childs:
+                child._set_missing_fields()
+                child.update_weight(weights)
+            suggestion.update_weight(weights)
+
+    def _set_missing_fields(self):
+        "Set to None or their default the fields missing on a new suggestion"
+        for field in ('parent', 'date', 'related_to', 'party', 'account',
+                'second_currency', 'amount_second_currency', 'based_on'):
+            if not hasattr(self, field):
+                setattr(self, field, None)
+        if not hasattr(self, 'childs'):
+            self.childs = []
+        if not hasattr(self, 'state'):
+            self.state = self.default_state()
+
+    def update_weight(self, weights=None):
+        '''
+        Compute the weight of the suggestion with weights, the WeightProfile
+        of the journal of its origin by default.
+        '''
         self.weight = 0
 
-        journal = self.origin.statement.journal
+        if weights is None:
+            weights = self.origin.statement.journal.get_weight_profile()
         if not self.parent:
-            TYPE_WEIGHTS = {
-                None: 0,
-                'combination-party': journal.get_weight(
-                    'type-combination-party'),
-                'combination-all': journal.get_weight('type-combination-all'),
-                'payment-group': journal.get_weight('type-payment-group'),
-                'payment': journal.get_weight('type-payment'),
-                'origin': journal.get_weight('type-origin'),
-                'balance': journal.get_weight('type-balance'),
-                'balance-invoice': journal.get_weight('type-balance-invoice'),
-                'sale': journal.get_weight('type-sale'),
-                }
-            self.weight += TYPE_WEIGHTS[self.type]
-
-        party_uniformity = journal.get_weight('party-uniformity')
+            self.weight += weights.type_weight(self.type)
+
+        party_uniformity = weights.party_uniformity
 
         if self.childs:
             # TODO: If a suggestion has children, the larger the combination, the
@@ -2591,11 +3448,30 @@ class OriginSuggestedLine(Workflow, ModelSQL, ModelView, tree()):
             # number of parties is 1
             self.weight += party_uniformity
 
+        for type_, score in self.get_weight_features():
+            self.weight += int(round(
+                    getattr(weights, type_.replace('-', '_')) * score))
+
+    def get_weight_features(self):
+        '''
+        Return the list of (weight type, score) of a suggestion without
+        children, the scores being between 0 and 1.
+        update_weight adds each score multiplied by the weight of its type.
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        MoveLine = pool.get('account.move.line')
+        Payment = pool.get('account.payment')
+        try:
+            Sale = pool.get('sale.sale')
+        except KeyError:
+            Sale = None
+
+        features = []
         origin = self.origin
 
         # Update weight based on dates
         if origin and self.date:
-            DATE_WEIGHT = journal.get_weight('date-match')
             dates = set([origin.date])
             value_date = origin.information and origin.information.get('value_date')
             if value_date:
@@ -2611,15 +3487,14 @@ class OriginSuggestedLine(Workflow, ModelSQL, ModelView, tree()):
             for date in dates:
                 days = abs(self.date - date).days
                 dw.add(gaussian_score(days, 0, 10))
-            self.weight += int(round(DATE_WEIGHT * max(dw)))
+            features.append(('date-match', max(dw)))
 
         # Update weight based on party
         if origin and self.party:
-            PARTY_WEIGHT = journal.get_weight('party-match')
-            # Scale the similarity down to a value between 0 and 20
+            # Scale the similarity down to a value between 0 and 1
             similar_parties = origin.similar_parties()
-            self.weight += int(round(PARTY_WEIGHT * (similar_parties.get(
-                self.party.id, 0) / 100)))
+            features.append(('party-match',
+                    similar_parties.get(self.party.id, 0) / 100))
 
         # Update weight based on invoice number
         invoice = None
@@ -2638,16 +3513,14 @@ class OriginSuggestedLine(Workflow, ModelSQL, ModelView, tree()):
             else:
                 number = invoice.reference
             if number:
-                NUMBER_WEIGHT = journal.get_weight('number-match')
-                # Scale the similarity down to a value between 0 and 20
                 # Given that it relatively easy that two or three characters
                 # match we use a normal distribution with a mean of the length
                 # of the number and a standard deviation of half the length of
                 # the number instead of computing a simple percentage so short
                 # matching strings do not affect to much on the weight
-                length = longest_common_substring(origin.remittance_information,
-                    number)
-                self.weight += int(round(NUMBER_WEIGHT * gaussian_score(length,
+                length = longest_common_substring(
+                    origin.clean_remittance_information or '', number)
+                features.append(('number-match', gaussian_score(length,
                             mean=len(number), stddev=len(number) / 4)))
 
         # Update weight based on sale number
@@ -2656,20 +3529,20 @@ class OriginSuggestedLine(Workflow, ModelSQL, ModelView, tree()):
             sale = self.related_to
 
         if sale and sale.number:
-            SALE_NUMBER_WEIGHT = journal.get_weight('number-match')
-            length = longest_common_substring(origin.remittance_information,
-                sale.number)
-            self.weight += int(round(SALE_NUMBER_WEIGHT * gaussian_score(
-                length, mean=len(sale.number),
-                stddev=len(sale.number) / 4)))
+            length = longest_common_substring(
+                origin.clean_remittance_information or '', sale.number)
+            features.append(('number-match', gaussian_score(
+                        length, mean=len(sale.number),
+                        stddev=len(sale.number) / 4)))
 
         if self.based_on:
-            BASED_ON_WEIGHT = journal.get_weight('based-on-match')
-            length = longest_common_substring(origin.remittance_information,
-                self.based_on.remittance_information)
-            rl = len(self.origin.remittance_information)
-            self.weight += int(round(BASED_ON_WEIGHT * gaussian_score(length,
-                    mean=rl, stddev=rl / 4)))
+            length = longest_common_substring(
+                origin.clean_remittance_information or '',
+                self.based_on.clean_remittance_information or '')
+            rl = len(origin.clean_remittance_information or '')
+            features.append(('based-on-match', gaussian_score(length,
+                        mean=rl, stddev=rl / 4)))
+        return features
 
     @classmethod
     def pack(cls, suggestions):
@@ -2688,34 +3561,75 @@ class OriginSuggestedLine(Workflow, ModelSQL, ModelView, tree()):
         for suggestion in suggestions:
             suggestion.type = None
             suggestion.parent = parent
-            for field in ('date', 'related_to', 'party', 'account',
-                    'second_currency', 'amount_second_currency', 'based_on'):
-                if not hasattr(suggestion, field):
-                    setattr(suggestion, field, None)
+            suggestion._set_missing_fields()
             suggestion.childs = []
-            suggestion.update_weight()
             amount += suggestion.amount
 
         parent.childs = suggestions
         parent.amount = amount
         return parent
 
+    def get_key(self):
+        '''
+        Return the key of the suggestion, two suggestions with the same key
+        create the same statement lines
+        '''
+        # We use str simply to prevent errors due to comparing None
+        # with other things when sorting, as sorted is required for
+        # groupby but also to ensure that two suggestions with the same
+        # children have the same key. The Many2One may be set with an id or
+        # a record and the amounts with different exponents.
+        def record(value):
+            return str(int(value)) if value is not None else ''
+
+        def amount(value):
+            return str(value.normalize()) if value is not None else ''
+
+        if not self.parent:
+            children = tuple(sorted([x.get_key() for x in self.childs]))
+        else:
+            children = tuple()
+        return (record(self.origin), record(self.account),
+            record(self.party), str(self.related_to), str(self.date),
+            amount(self.amount), record(self.second_currency),
+            amount(self.amount_second_currency), children)
+
+    def get_identity(self):
+        "Return the hash of the key stored in identity"
+        return hashlib.sha1(repr(self.get_key()).encode()).hexdigest()
+
+    def update_from(self, suggestion):
+        '''
+        Copy the values found by a new search of the suggestion with the same
+        identity and return the records to save
+        '''
+        to_save = []
+        names = ['weight', 'type', 'strategy', 'identity']
+        # The search is not run while the suggestions are used by a statement
+        # line, so they are proposed again
+        if (self.state != 'proposed'
+                or any(getattr(self, x) != getattr(suggestion, x)
+                    for x in names)):
+            for name in names:
+                setattr(self, name, getattr(suggestion, name))
+            self.state = 'proposed'
+            to_save.append(self)
+        children = sorted(self.childs, key=lambda x: x.get_key())
+        for child, new_child in zip(children,
+                sorted(suggestion.childs, key=lambda x: x.get_key())):
+            if (child.state != 'proposed'
+                    or child.weight != new_child.weight
+                    or child.strategy != new_child.strategy):
+                child.weight = new_child.weight
+                child.strategy = new_child.strategy
+                child.state = 'proposed'
+                to_save.append(child)
+        return to_save
+
     @classmethod
     def merge_suggestions(cls, suggestions):
         suggestions = [x for x in suggestions if not x.parent]
-        def get_key(x):
-            if not x.parent:
-                children = tuple(sorted([get_key(y) for y in x.childs]))
-            else:
-                children = tuple()
-            # We use str simply to prevent errors due to comparing None
-            # with other things when sorting, as sorted is required for
-            # groupby but also to ensure that two suggestions with the same
-            # children have the same key
-            return (str(x.origin), str(x.account), str(x.party),
-                str(x.related_to), str(x.date), x.amount,
-                str(x.second_currency), str(x.amount_second_currency),
-                children)
+        get_key = cls.get_key
 
         # Given that sort honours the original order of the elements
         # We first sort by weight, so the first element of each group
@@ -2758,6 +3672,7 @@ class OriginSuggestedLine(Workflow, ModelSQL, ModelView, tree()):
         StatementLine = pool.get('account.statement.line')
         MoveLine = pool.get('account.move.line')
         Warning = pool.get('res.user.warning')
+        Stat = pool.get('account.statement.origin.suggestion.stat')
 
         to_save = []
         to_warn = []
@@ -2794,6 +3709,7 @@ class OriginSuggestedLine(Workflow, ModelSQL, ModelView, tree()):
                         'msg_not_use_blocked_account_move',
                         move_lines=names))
         StatementLine.save(to_save)
+        Stat.mark(suggestions, 'used')
 
 
 class AddMultipleInvoices(Wizard):
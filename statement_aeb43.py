@@ -2,8 +2,6 @@
 # this repository contains the full copyright notices and license terms.
 from datetime import datetime
 from trytond.pool import Pool, PoolMeta
-from trytond.transaction import Transaction
-from .journal import QUEUE_NAME
 
 class ImportStatement(metaclass=PoolMeta):
     __name__ = 'account.statement.import'
@@ -19,14 +17,12 @@ class ImportStatement(metaclass=PoolMeta):
             statements = Statement.browse(statement_ids)
             for statement in statements:
                 # Get the suggested lines for each origin created
-                # Use __queue__ to ensure the Bank lines download and origin
+                # Use the queue to ensure the Bank lines download and origin
                 # creation are done and saved before start to create their
                 # suggestions.
                 if statement.journal and statement.journal.search_suggestions:
-                    with Transaction().set_context(queue_name=QUEUE_NAME):
-                        for origin in statement.origins:
-                            StatementOrigin.__queue__.search_suggestions(
-                                [origin])
+                    StatementOrigin.enqueue_search_suggestions(
+                        statement.origins)
 
         return action, data
 
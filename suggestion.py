@@ -0,0 +1,275 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import heapq
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import count
+from time import monotonic
+from weakref import WeakKeyDictionary
+
+_memos = WeakKeyDictionary()
+
+
+def get_memo(transaction):
+    '''
+    Return the dictionary where the similarity searches of the origins are
+    memoized for the life of transaction.
+    '''
+    memo = _memos.get(transaction)
+    if memo is None:
+        memo = _memos[transaction] = {}
+    return memo
+
+
+class SuggestionRun:
+    '''
+    State shared by the origins of a search_suggestions call.
+
+    The records can not store attributes, so the run is kept in the memo of
+    the transaction while started and the state of each origin is kept by
+    id in searches.
+    '''
+
+    def __init__(self):
+        self.snapshots = {}
+        # The results of the batch strategies by strategy name
+        self.batches = {}
+        # The OriginSearch by origin id
+        self.searches = {}
+
+    @classmethod
+    @contextmanager
+    def start(cls, transaction):
+        'Make a new run the current one of transaction while in the context'
+        memo = get_memo(transaction)
+        run = memo['suggestion_run'] = cls()
+        try:
+            yield run
+        finally:
+            if memo.get('suggestion_run') is run:
+                del memo['suggestion_run']
+
+    @staticmethod
+    def current(transaction):
+        'Return the started run of transaction or None'
+        return get_memo(transaction).get('suggestion_run')
+
+    def get_snapshot(self, key, load):
+        'Return the move line snapshot of key, loading it the first time'
+        if key not in self.snapshots:
+            self.snapshots[key] = load()
+        return self.snapshots[key]
+
+
+class OriginSearch:
+    'State of the suggestion search of an origin'
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.escape_tracker = EscapeTracker(weights.escape_threshold,
+            weights.combination_escape_threshold)
+        self.deadline = None
+        # The StrategyStat of the running strategy
+        self.strategy_stat = None
+        # The TopSuggestions found by the strategies, saved at the end of
+        # the search
+        self.new_suggestions = None
+
+
+class EscapeTracker:
+    """
+    Keep the best weights of the suggestions found for an origin to decide
+    in memory if the search can stop.
+    """
+
+    def __init__(self, threshold, combination_threshold):
+        self.threshold = threshold
+        self.combination_threshold = combination_threshold
+        self.best = None
+        self.best_combination = None
+
+    def add(self, type_, weight):
+        if self.best is None or weight > self.best:
+            self.best = weight
+        if type_ and type_.startswith('combination'):
+            if self.best_combination is None or weight > self.best_combination:
+                self.best_combination = weight
+
+    def escape(self):
+        if self.best is not None and self.best > self.threshold:
+            return True
+        return (self.best_combination is not None
+            and self.best_combination >= self.combination_threshold)
+
+
+class TopSuggestions:
+    '''
+    Keep in a bounded heap the size suggestions with the greatest weight,
+    only the best one of each key. Between equal weights, the first added
+    is kept. No limit if size is 0.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self._heap = []
+        self._best = {}
+        self._counter = count()
+
+    def __len__(self):
+        return len(self._best)
+
+    def add(self, key, weight, suggestion):
+        best = self._best.get(key)
+        if best is not None:
+            if best[0] >= weight:
+                return
+            # Removed lazily when it reaches the top of the heap
+            best[3] = None
+        entry = [weight, -next(self._counter), key, suggestion]
+        self._best[key] = entry
+        heapq.heappush(self._heap, entry)
+        while self.size and len(self._best) > self.size:
+            _, _, key, suggestion = heapq.heappop(self._heap)
+            if suggestion is not None:
+                del self._best[key]
+
+    def items(self):
+        "Return the suggestions kept from the greatest weight"
+        return [x[3] for x in sorted(self._best.values(), reverse=True)]
+
+
+class Deadline:
+    'Wall-clock limit of the suggestion search of an origin'
+
+    def __init__(self, milliseconds):
+        # No limit if milliseconds is 0
+        self.at = (monotonic() + milliseconds / 1000
+            if milliseconds else None)
+
+    def expired(self):
+        return self.at is not None and monotonic() >= self.at
+
+    def limit(self, milliseconds):
+        '''
+        Return a Deadline reached after milliseconds or at this one if it is
+        sooner
+        '''
+        deadline = Deadline(milliseconds)
+        if deadline.at is None or (self.at is not None
+                and self.at < deadline.at):
+            deadline.at = self.at
+        return deadline
+
+
+class Strategy(namedtuple('Strategy',
+            ['name', 'cost', 'batch', 'weight_type', 'budget'],
+            defaults=['cheap', False, None, 0])):
+    '''
+    A strategy of the suggestion search run by Origin._suggest_<name>.
+
+    cost is 'cheap' or 'expensive', the expensive strategies are skipped if
+    their weight_type weighs 0 or once a suggestion escapes the search with
+    a greater weight than the ones they can find.
+    If batch is set, Origin._suggest_<name>_batch is called once with all
+    the origins of the search before running the strategy on each one.
+    budget is the maximum time of each run in milliseconds, 0 to only be
+    limited by the time limit of the origin.
+    '''
+    __slots__ = ()
+
+
+class QueryCounter:
+    """
+    Count the queries executed by the cursors of transaction while entered.
+
+    The connection of the transaction is wrapped while counting, so only the
+    queries of the transaction are counted and the database logger is left
+    untouched.
+    """
+
+    def __init__(self, transaction):
+        self.transaction = transaction
+        self.count = 0
+        self._connection = None
+
+    def __enter__(self):
+        self._connection = self.transaction.connection
+        self.transaction.connection = _CountingConnection(
+            self._connection, self)
+        return self
+
+    def __exit__(self, *exc):
+        self.transaction.connection = self._connection
+
+
+class _CountingConnection:
+
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._counter)
+
+
+class _CountingCursor:
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+
+class StrategyStat:
+    'Measures of the run of a suggestion strategy on an origin'
+
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.duration = 0
+        self.queries = 0
+        self.candidates = 0
+        self.suggestions = 0
+
+    def measure(self, transaction=None):
+        """
+        Return a context manager which adds the wall time, and the queries
+        of transaction if set, of its block to the stat.
+        """
+        return _Measure(self, transaction)
+
+
+class _Measure:
+
+    def __init__(self, stat, transaction):
+        self.stat = stat
+        self.counter = QueryCounter(transaction) if transaction else None
+        self.start = None
+
+    def __enter__(self):
+        if self.counter:
+            self.counter.__enter__()
+        self.start = monotonic()
+        return self.stat
+
+    def __exit__(self, *exc):
+        self.stat.duration += monotonic() - self.start
+        if self.counter:
+            self.counter.__exit__(*exc)
+            self.stat.queries += self.counter.count
@@ -1,13 +1,127 @@
 # This file is part account_statement_enable_banking module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
+import time
+import unittest
+from decimal import Decimal
+from itertools import combinations
 from unittest.mock import patch
 
 from trytond.exceptions import UserError
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_statement_enable_banking import combination
+from trytond.modules.account_statement_enable_banking.combination import (
+    MoveLineSnapshot, find_combinations, suffix_bounds, to_int)
 from trytond.modules.account_statement_enable_banking.common import (
     load_session_json)
+from trytond.modules.account_statement_enable_banking.journal import (
+    DEFAULT_WEIGHTS, WeightProfile)
+from trytond.modules.account_statement_enable_banking.matching import (
+    SuffixAutomaton)
+from trytond.modules.account_statement_enable_banking.suggestion import (
+    Deadline, EscapeTracker, OriginSearch, Strategy, StrategyStat,
+    SuggestionRun, TopSuggestions, get_memo)
+from trytond.modules.account_statement_enable_banking.tuning import (
+    evaluate, tune)
+from trytond.modules.company.tests import create_company, set_company
 from trytond.pool import Pool
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+def create_origins(company, amounts):
+    "Create a statement of company with an origin for each amount"
+    pool = Pool()
+    Account = pool.get('account.account')
+    AccountJournal = pool.get('account.journal')
+    Sequence = pool.get('ir.sequence')
+    SequenceType = pool.get('ir.sequence.type')
+    Journal = pool.get('account.statement.journal')
+    Statement = pool.get('account.statement')
+    Origin = pool.get('account.statement.origin')
+    FiscalYear = pool.get('account.fiscalyear')
+    Date = pool.get('ir.date')
+
+    fiscalyear = get_fiscalyear(company)
+    fiscalyear.save()
+    FiscalYear.create_period([fiscalyear])
+    create_chart(company)
+    cash, = Account.search([
+            ('company', '=', company.id),
+            ('code', '=', '1.1.1'),
+            ], limit=1)
+    sequence_type, = SequenceType.search([
+            ('name', '=', 'Account Statement Origin'),
+            ], limit=1)
+    sequence, = Sequence.create([{
+                'name': 'Statement Origin',
+                'sequence_type': sequence_type.id,
+                'company': company.id,
+                }])
+    account_journal, = AccountJournal.create([{
+                'name': 'Statement',
+                'type': 'statement',
+                }])
+    journal, = Journal.create([{
+                'name': 'Bank',
+                'journal': account_journal.id,
+                'currency': company.currency.id,
+                'company': company.id,
+                'account': cash.id,
+                'validation': 'balance',
+                'account_statement_origin_sequence': sequence.id,
+                }])
+    today = Date.today()
+    statement, = Statement.create([{
+                'name': 'Statement',
+                'company': company.id,
+                'journal': journal.id,
+                'date': today,
+                'start_balance': Decimal(0),
+                'end_balance': sum(amounts, Decimal(0)),
+                }])
+    return Origin.create([{
+                'statement': statement.id,
+                'date': today,
+                'amount': amount,
+                'information': {
+                    'remittance_information': 'Invoice %s' % i,
+                    },
+                } for i, amount in enumerate(amounts, 1)])
+
+
+def create_move_line(party, amount, maturity_date=None):
+    "Post a move with a receivable line of amount for party"
+    pool = Pool()
+    Account = pool.get('account.account')
+    Journal = pool.get('account.journal')
+    Move = pool.get('account.move')
+    Line = pool.get('account.move.line')
+    Period = pool.get('account.period')
+    Date = pool.get('ir.date')
+
+    journal, = Journal.search([('code', '=', 'REV')])
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('closed', '=', False),
+            ], limit=1)
+    receivable, = Account.search([
+            ('type.receivable', '=', True),
+            ('closed', '=', False),
+            ], limit=1)
+    today = Date.today()
+    move = Move(
+        period=Period.find(receivable.company, date=today),
+        journal=journal,
+        date=today)
+    line = Line(account=receivable, debit=amount, party=party,
+        maturity_date=maturity_date)
+    move.lines = [Line(account=revenue, credit=amount), line]
+    move.save()
+    Move.post([move])
+    line, = [l for l in move.lines if l.account == receivable]
+    return line
 
 
 class AccountStatementEnableBankingTestCase(ModuleTestCase):
@@ -20,6 +134,397 @@ class AccountStatementEnableBankingTestCase(ModuleTestCase):
         with self.assertRaises(UserError):
             load_session_json(None)
 
+    def test_find_combinations(self):
+        lines = [(1, 300), (2, -50), (3, 120), (4, 250), (5, 180), (6, 70),
+            (7, -120), (8, 50)]
+        for amount, tolerance in [(300, 0), (250, 0), (130, 10), (0, 0)]:
+            expected = [c for length in range(1, 5)
+                for c in combinations(lines, length)
+                if abs(sum(x[1] for x in c) - amount) <= tolerance]
+            self.assertEqual(list(find_combinations(lines, amount,
+                        tolerance=tolerance, max_length=4)), expected)
+
+    def test_find_combinations_first_only(self):
+        lines = [(1, 100), (2, 100), (3, 50), (4, 50), (5, 25), (6, 75)]
+        self.assertEqual(list(find_combinations(lines, 150, max_length=3,
+                    first_only=True)), [
+                ((1, 100), (3, 50)),
+                ((3, 50), (5, 25), (6, 75)),
+                ])
+
+    def test_find_combinations_budget(self):
+        "The budget is spread over the first lines"
+        lines = [(i, 1000 + (i * 7919) % 500000) for i in range(500)]
+        amount = sum(lines[i][1] for i in [10, 20, 30, 35])
+        self.assertIn(tuple(lines[i] for i in [10, 20, 30, 35]),
+            list(find_combinations(lines, amount, max_length=4,
+                    budget=20_000)))
+
+    def test_find_combinations_deadline(self):
+        lines = [(1, 100), (2, 50), (3, 50)]
+        self.assertEqual(list(find_combinations(lines, 100, max_length=2,
+                    deadline=time.monotonic() - 1)), [])
+        self.assertEqual(list(find_combinations(lines, 100, max_length=2,
+                    deadline=time.monotonic() + 60)), [
+                ((1, 100),),
+                ((2, 50), (3, 50)),
+                ])
+
+    def test_find_combinations_processes(self):
+        lines = [(i, (i * 37) % 101 - 50) for i in range(
+                combination.PARALLEL_MIN_LINES)]
+        for first_only in [False, True]:
+            self.assertEqual(
+                list(find_combinations(lines, 42, tolerance=1, max_length=3,
+                        budget=1000, first_only=first_only, processes=2)),
+                list(find_combinations(lines, 42, tolerance=1, max_length=3,
+                        budget=1000, first_only=first_only)))
+
+    def test_find_combinations_limit(self):
+        lines = [(i, (i * 37) % 101 - 50) for i in range(
+                combination.PARALLEL_MIN_LINES)]
+        found = list(find_combinations(lines, 42, tolerance=1, max_length=3,
+                budget=1000, limit=2))
+        self.assertEqual(
+            [len(c) for c in found], [1, 1, 2, 2, 3, 3])
+        self.assertEqual(
+            list(find_combinations(lines, 42, tolerance=1, max_length=3,
+                    budget=1000, limit=2, processes=2)),
+            found)
+
+    @unittest.skipIf(combination.np is None, "NumPy not installed")
+    def test_find_combinations_vectorized(self):
+        lines = [(i, (i * 37) % 101 - 50) for i in range(
+                combination.VECTORIZE_MIN_LINES)]
+        expected = [c for length in range(1, 4)
+            for c in combinations(lines, length)
+            if abs(sum(x[1] for x in c) - 42) <= 1]
+        self.assertEqual(list(find_combinations(lines, 42, tolerance=1,
+                    max_length=3)), expected)
+
+    def test_suffix_bounds(self):
+        lows, highs = suffix_bounds([100, -20, 50, -80], 2)
+        self.assertEqual(lows[0], (0, -80, -100))
+        self.assertEqual(highs[0], (0, 100, 150))
+        self.assertEqual(lows[2], (0, -80, -30))
+        self.assertEqual(highs[2], (0, 50, -30))
+
+    def test_move_line_snapshot(self):
+        today = datetime.date.today()
+        snapshot = MoveLineSnapshot([
+                (1, 1000, 10, today),
+                (2, -500, None, today),
+                (3, 250, 11, today),
+                ])
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual(snapshot.select(), [
+                (1, 1000, today), (2, -500, today), (3, 250, today)])
+        self.assertEqual(snapshot.select([10, 11]), [
+                (1, 1000, today), (3, 250, today)])
+        self.assertEqual(snapshot.select([]), [])
+
+    def test_suffix_automaton(self):
+        automaton = SuffixAutomaton('factura 2024 001 acme')
+        for needle, length in [
+                ('2024 001', 8),
+                ('fra 2024 002', 10),
+                ('acme inc', 4),
+                ('xyz', 0),
+                ('', 0),
+                ]:
+            self.assertEqual(
+                automaton.longest_common_substring(needle), length)
+        self.assertEqual(
+            SuffixAutomaton('').longest_common_substring('abc'), 0)
+
+    def test_weight_profile(self):
+        weights = WeightProfile(**{k.replace('-', '_'): v
+                for k, v in DEFAULT_WEIGHTS.items()})
+        self.assertEqual(weights.escape_threshold,
+            DEFAULT_WEIGHTS['escape-threshold'])
+        self.assertEqual(weights.type_weight('balance-invoice'),
+            DEFAULT_WEIGHTS['type-balance-invoice'])
+        self.assertEqual(weights.type_weight(None), 0)
+        self.assertEqual(weights.max_weight('sale'),
+            DEFAULT_WEIGHTS['type-sale'] + 120)
+        self.assertEqual(weights.to_weights(), DEFAULT_WEIGHTS)
+
+    def test_tune(self):
+        weights = dict(DEFAULT_WEIGHTS, **{'party-match': 0, 'date-match': 50})
+        # The posted suggestion matches the party, the other one the date
+        case = (0, [
+                ('balance', None, ((('party-match', 1),),)),
+                ('balance', None, ((('date-match', 1),),)),
+                ])
+        self.assertEqual(evaluate([case], weights), 0)
+        best, initial, hits = tune([case], weights, keys=['party-match'])
+        self.assertEqual((initial, hits), (0, 1))
+        self.assertGreater(best['party-match'], 50)
+        self.assertEqual(evaluate([case], best), 1)
+
+    def test_deadline_limit(self):
+        self.assertIsNone(Deadline(0).limit(0).at)
+        self.assertIsNotNone(Deadline(0).limit(1000).at)
+        deadline = Deadline(1000)
+        self.assertEqual(deadline.limit(60_000).at, deadline.at)
+        self.assertLess(deadline.limit(10).at, deadline.at)
+        self.assertEqual(deadline.limit(0).at, deadline.at)
+
+    def test_strategy(self):
+        strategy = Strategy('payment')
+        self.assertEqual(strategy.cost, 'cheap')
+        self.assertFalse(strategy.batch)
+        self.assertIsNone(strategy.weight_type)
+        self.assertEqual(strategy.budget, 0)
+
+    @with_transaction()
+    def test_strategy_stat(self):
+        transaction = Transaction()
+        connection = transaction.connection
+        stat = StrategyStat('payment')
+        with stat.measure(transaction):
+            cursor = Transaction().connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.execute('SELECT 2')
+            self.assertEqual(list(cursor), [(2,)])
+        with stat.measure():
+            Transaction().connection.cursor().execute('SELECT 3')
+        self.assertEqual(stat.strategy, 'payment')
+        self.assertEqual(stat.queries, 2)
+        self.assertGreater(stat.duration, 0)
+        self.assertIs(transaction.connection, connection)
+
+    def test_top_suggestions(self):
+        top = TopSuggestions(3)
+        for key, weight in [('a', 10), ('b', 30), ('c', 20), ('a', 40),
+                ('d', 5), ('e', 30), ('b', 1), ('f', 30)]:
+            top.add(key, weight, f'{key}{weight}')
+        self.assertEqual(top.items(), ['a40', 'b30', 'e30'])
+        self.assertEqual(len(top), 3)
+
+        unbounded = TopSuggestions(0)
+        for weight in range(5):
+            unbounded.add(weight, weight, weight)
+        self.assertEqual(unbounded.items(), [4, 3, 2, 1, 0])
+
+    def test_escape_tracker(self):
+        tracker = EscapeTracker(150, 130)
+        self.assertFalse(tracker.escape())
+        tracker.add('combination-all', 120)
+        tracker.add('payment', 140)
+        self.assertFalse(tracker.escape())
+        tracker.add('combination-party', 130)
+        self.assertTrue(tracker.escape())
+
+        tracker = EscapeTracker(150, 130)
+        tracker.add('payment', 151)
+        self.assertTrue(tracker.escape())
+
+    @with_transaction()
+    def test_origin_clean_information(self):
+        pool = Pool()
+        Origin = pool.get('account.statement.origin')
+
+        information = {
+            'remittance_information': 'Factura 2024/001-A',
+            'debtor_name': 'José Pérez, S.L.',
+            'creditor_name': 'ACME Inc.',
+            }
+        self.assertEqual(Origin._clean_information(information, 10), {
+                'clean_remittance_information': 'factura 2024 001 a',
+                'clean_counterpart_name': 'jose perez s l',
+                })
+        self.assertEqual(
+            Origin._clean_information(information, -10)[
+                'clean_counterpart_name'], 'acme inc')
+        self.assertEqual(Origin._clean_information(None, 10), {
+                'clean_remittance_information': None,
+                'clean_counterpart_name': None,
+                })
+
+    @with_transaction()
+    def test_suggested_line_identity(self):
+        pool = Pool()
+        SuggestedLine = pool.get('account.statement.origin.suggested.line')
+
+        def suggestion(amount):
+            line = SuggestedLine(origin=None, type='combination-all',
+                amount=amount)
+            line._set_missing_fields()
+            return line
+
+        self.assertEqual(suggestion(Decimal('10')).get_identity(),
+            suggestion(Decimal('10.00')).get_identity())
+        self.assertNotEqual(suggestion(Decimal('10')).get_identity(),
+            suggestion(Decimal('11')).get_identity())
+
+        packed = SuggestedLine.pack(
+            [suggestion(Decimal('4')), suggestion(Decimal('6'))])
+        packed._set_missing_fields()
+        other = SuggestedLine.pack(
+            [suggestion(Decimal('6.0')), suggestion(Decimal('4'))])
+        other._set_missing_fields()
+        self.assertEqual(packed.get_identity(), other.get_identity())
+
+    @with_transaction()
+    def test_origin_watch_values(self):
+        pool = Pool()
+        Watch = pool.get('account.statement.origin.watch')
+
+        self.assertEqual(Watch.amount_value(Decimal('-12.50'), 1),
+            Watch.amount_value(Decimal('12.5'), 1))
+        self.assertNotEqual(Watch.amount_value(Decimal('12.5'), 1),
+            Watch.amount_value(Decimal('12.5'), 2))
+        self.assertEqual(Watch.reference_values('Factura 2024/001-A ref 7'),
+            set())
+        self.assertEqual(
+            Watch.reference_values('Factura FV24-00012345 de 2024'),
+            {'fv24', '00012345'})
+        self.assertEqual(Watch.reference_values(None), set())
+
+    @with_transaction()
+    def test_origin_watch_notify(self):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Queue = pool.get('ir.queue')
+        Origin = pool.get('account.statement.origin')
+        Watch = pool.get('account.statement.origin.watch')
+
+        company = create_company()
+        with set_company(company):
+            origin1, origin2 = create_origins(
+                company, [Decimal('100'), Decimal('200')])
+            Origin.search_suggestions([origin1, origin2])
+            party, = Party.create([{'name': 'Party'}])
+
+            create_move_line(party, Decimal('300'))
+            self.assertEqual(Queue.search([], count=True), 0)
+
+            create_move_line(party, Decimal('200'))
+            task, = Queue.search([])
+            self.assertEqual(list(task.data['instances']), [origin2.id])
+
+            # The origins are only queued once per transaction
+            Watch.notify([('amount',
+                        Watch.amount_value(Decimal('200'), company.currency))])
+            self.assertEqual(Queue.search([], count=True), 1)
+
+    @with_transaction()
+    def test_search_suggestions_chunk(self):
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+        Origin = pool.get('account.statement.origin')
+        Watch = pool.get('account.statement.origin.watch')
+
+        company = create_company()
+        with set_company(company):
+            origins = create_origins(company, [Decimal('100'), Decimal('200')])
+            Origin.search_suggestions_chunk(origins)
+
+            self.assertEqual(Queue.search([], count=True), 0)
+            watches = Watch.search([('kind', '=', 'amount')])
+            self.assertEqual(
+                {w.origin for w in watches}, set(origins))
+
+    @with_transaction()
+    def test_load_move_line_snapshot(self):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            origin, = create_origins(company, [Decimal('100')])
+            party, = Party.create([{'name': 'Party'}])
+            today = Date.today()
+            maturity_date = today + datetime.timedelta(days=30)
+            line1 = create_move_line(party, Decimal('40'))
+            line2 = create_move_line(party, Decimal('60'), maturity_date)
+
+            self.assertEqual(origin._load_move_line_snapshot().select(), [
+                    (line1.id, to_int(Decimal('40')), today),
+                    (line2.id, to_int(Decimal('60')), maturity_date),
+                    ])
+
+    @with_transaction()
+    def test_combination_candidates(self):
+        pool = Pool()
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            origin, = create_origins(company, [Decimal('100')])
+            party1, party2 = Party.create([{'name': 'Party 1'}, {
+                        'name': 'Party 2'}])
+            line1 = create_move_line(party1, Decimal('40'))
+            create_move_line(party2, Decimal('60'))
+            key = origin._move_line_snapshot_key()
+
+            with SuggestionRun.start(Transaction()) as run:
+                self.assertEqual([x[0]
+                        for x in origin._get_combination_candidates(
+                            [party1])], [line1.id])
+                self.assertEqual(list(run.snapshots), [key])
+
+            # Only the lines of the parties are loaded without combination-all
+            weights = origin.journal.get_weight_profile()
+            with SuggestionRun.start(Transaction()) as run:
+                run.searches[origin.id] = OriginSearch(
+                    weights._replace(type_combination_all=0))
+                self.assertEqual([x[0]
+                        for x in origin._get_combination_candidates(
+                            [party1])], [line1.id])
+                self.assertEqual(list(run.snapshots), [key + ((party1.id,),)])
+            self.assertIsNone(SuggestionRun.current(Transaction()))
+
+    @with_transaction()
+    def test_search_suggestions_after_deleting_lines(self):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Origin = pool.get('account.statement.origin')
+        SuggestedLine = pool.get('account.statement.origin.suggested.line')
+        StatementLine = pool.get('account.statement.line')
+
+        company = create_company()
+        with set_company(company):
+            origin, = create_origins(company, [Decimal('100')])
+            party, = Party.create([{'name': 'Party'}])
+            create_move_line(party, Decimal('40'))
+            create_move_line(party, Decimal('60'))
+
+            with patch.object(Origin, '_get_strategies',
+                    return_value=[Strategy('combination_all')]):
+                Origin.search_suggestions([Origin(origin.id)])
+                suggestion, = SuggestedLine.search([
+                        ('origin', '=', origin.id),
+                        ('parent', '=', None),
+                        ])
+                self.assertEqual(len(suggestion.childs), 2)
+                SuggestedLine.use([suggestion])
+                StatementLine.delete(StatementLine.search([
+                            ('origin', '=', origin.id),
+                            ]))
+
+                Origin.search_suggestions([Origin(origin.id)])
+
+            suggestion, = SuggestedLine.search([
+                    ('origin', '=', origin.id),
+                    ('parent', '=', None),
+                    ])
+            SuggestedLine.use([suggestion])
+            self.assertEqual(SuggestedLine(suggestion.id).state, 'used')
+            self.assertEqual(StatementLine.search([
+                        ('origin', '=', origin.id),
+                        ], count=True), 2)
+
+    @with_transaction()
+    def test_memo(self):
+        transaction = Transaction()
+        get_memo(transaction)['key'] = 'value'
+        self.assertEqual(get_memo(transaction), {'key': 'value'})
+        with Transaction().new_transaction() as new_transaction:
+            self.assertEqual(get_memo(new_transaction), {})
+
     @with_transaction()
     def test_set_ebsession_updates_all_matching_journals(self):
         Journal = Pool().get('account.statement.journal')
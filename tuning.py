@@ -0,0 +1,116 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Offline tuning of the journal weights.
+
+A case is the snapshot of the suggestions of a posted origin: a tuple of
+(target, suggestions) where target is the index of the suggestion that
+matches the lines posted, or None, and each suggestion is a tuple of
+(type, parties, leaves). type is the suggestion type, parties the number of
+different parties of its children or None if it has no children, and leaves
+the tuple of the features of the suggestion itself or of its children, as
+returned by get_weight_features.
+
+The weights are scored in memory with the same formula as update_weight, so
+no database access is needed to try them.
+'''
+from .combination import get_executor
+
+# Weight types which change the order of the suggestions
+TUNABLE_WEIGHTS = (
+    'based-on-match',
+    'date-match',
+    'number-match',
+    'party-match',
+    'party-uniformity',
+    'type-balance',
+    'type-balance-invoice',
+    'type-combination-all',
+    'type-combination-party',
+    'type-origin',
+    'type-payment',
+    'type-payment-group',
+    'type-sale',
+    )
+TUNING_VALUES = range(0, 205, 5)
+TUNING_ROUNDS = 3
+
+
+def leaf_weight(weights, features):
+    return sum(int(round(weights[type_] * score)) for type_, score in features)
+
+
+def suggestion_weight(weights, suggestion):
+    'Return the weight of suggestion like OriginSuggestedLine.update_weight'
+    type_, parties, leaves = suggestion
+    weight = weights['type-' + type_] if type_ else 0
+    party_uniformity = weights['party-uniformity']
+    if parties is None:
+        features, = leaves
+        return weight + party_uniformity + leaf_weight(weights, features)
+    weight += (sum(leaf_weight(weights, x) for x in leaves) / len(leaves))
+    if parties <= 1:
+        weight += party_uniformity
+    elif parties == 2:
+        weight += party_uniformity // 2
+    return weight
+
+
+def evaluate(cases, weights):
+    '''
+    Return the number of cases whose target suggestion has a greater weight
+    than all the others, so search_suggestions would use it.
+    '''
+    hits = 0
+    for target, suggestions in cases:
+        if target is None:
+            continue
+        scores = [suggestion_weight(weights, x) for x in suggestions]
+        best = scores[target]
+        if all(x < best for i, x in enumerate(scores) if i != target):
+            hits += 1
+    return hits
+
+
+def _evaluate_many(cases, candidates):
+    return [evaluate(cases, x) for x in candidates]
+
+
+def tune(cases, weights, keys=TUNABLE_WEIGHTS, values=TUNING_VALUES,
+        rounds=TUNING_ROUNDS, processes=0):
+    '''
+    Search the weights that maximize evaluate with a coordinate search.
+
+    Each weight of keys is tried with all the values while the others are
+    fixed, and the best one is kept, for up to rounds rounds or until no
+    weight improves. If processes is set, the values are evaluated in the pool
+    of processes shared with the combination search.
+
+    Return the best weights found and the hits of the initial and best
+    weights.
+    '''
+    best = dict(weights)
+    initial = best_hits = evaluate(cases, best)
+    for _ in range(rounds):
+        improved = False
+        for key in keys:
+            candidates = [dict(best, **{key: x}) for x in values
+                if x != best[key]]
+            if processes:
+                executor = get_executor(processes)
+                futures = [
+                    executor.submit(_evaluate_many, cases,
+                        candidates[i::processes])
+                    for i in range(processes)]
+                hits = [None] * len(candidates)
+                for i, future in enumerate(futures):
+                    hits[i::processes] = future.result()
+            else:
+                hits = _evaluate_many(cases, candidates)
+            for candidate, candidate_hits in zip(candidates, hits):
+                if candidate_hits > best_hits:
+                    best, best_hits = candidate, candidate_hits
+                    improved = True
+        if not improved:
+            break
+    return best, initial, best_hits